@@ -1,6 +1,5 @@
 import sys
 import time
-import ptctx
 
 def print_logo():
   # https://patorjk.com/software/taag/#p=display&f=Standard&t=PT%202.0
@@ -22,19 +21,62 @@ def print_logo():
   print(sep)
 
 if __name__ == '__main__':
+  # python pt serve|stop [socket]
+  if len(sys.argv) > 1 and sys.argv[1] in ['serve', 'stop']:
+    import ptserve
+    socket_path = sys.argv[2] if len(sys.argv) > 2 else None
+    try:
+      ptserve.serve(socket_path) if sys.argv[1] == 'serve' else ptserve.stop(socket_path)
+    except OSError as ex:
+      print('ERROR: ' + str(ex))
+      sys.exit(1)
+    sys.exit(0)
+
   no_logo, no_cost_time = False, False
+  cache_dir, server = False, None
   if '-nologo' in sys.argv:
     no_logo = True
     sys.argv.remove('-nologo')
   if '-nocosttime' in sys.argv:
     no_cost_time = True
     sys.argv.remove('-nocosttime')
+  if '-cache' in sys.argv:
+    idx = sys.argv.index('-cache')
+    if idx + 1 < len(sys.argv):
+      cache_dir = sys.argv[idx + 1]
+    del sys.argv[idx:idx + 2]
+  if '-nocache' in sys.argv:
+    sys.argv.remove('-nocache')
+    cache_dir = None
+  if '-server' in sys.argv:
+    idx = sys.argv.index('-server')
+    server = sys.argv[idx + 1] if idx + 1 < len(sys.argv) else ''
+    del sys.argv[idx:idx + 2]
 
   # print logo
   if not no_logo:
     print_logo()
 
+  # execute by the render server, the client does not import ptctx
+  if server is not None:
+    if cache_dir is not False:
+      print('ERROR: The options "-cache" and "-nocache" can not be used with "-server", set PT_CACHE_DIR for the server.')
+      sys.exit(1)
+    import ptserve
+    start_time = time.time()
+    try:
+      sys.stdout.write(ptserve.execute(server or ptserve.default_socket(), sys.argv[1:]))
+    except (OSError, RuntimeError) as ex:
+      print('ERROR: ' + str(ex))
+      sys.exit(1)
+    if not no_cost_time:
+      print(f"(Cost time: {time.time() - start_time} seconds)")
+    sys.exit(0)
+
   # execute
+  import ptctx
+  if cache_dir is not False:
+    ptctx.PT.set_cache_dir(cache_dir)
   start_time = time.time()
   ptctx.PT.execute(sys.argv)
 
@@ -42,5 +84,12 @@ if __name__ == '__main__':
   if not no_cost_time:
     execution_time = time.time() - start_time
     print(f"(Cost time: {execution_time} seconds)")
+    written, unchanged = ptctx.PT.output_stats()
+    if written + unchanged > 0:
+      print(f"(Output files: {written} written, {unchanged} unchanged)")
+    cache_stats = ptctx.PT.cache_stats()
+    if cache_stats is not None:
+      hits, misses = cache_stats
+      print(f"(Template cache: {hits} hits, {misses} misses)")
 
 
@@ -0,0 +1,37 @@
+#-*- coding: UTF-8 -*-
+# Render test/templates/page.pt many times by PT.eval and by a compiled template.
+# Usage: python bench_compile.py [pt_dir] [count]
+#   pt_dir - the PT source directory to measure, defaults to the parent directory.
+#   count  - the number of renders, defaults to 100000.
+import os
+import sys
+import time
+
+sys.path.insert(0, sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ptctx import PT
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'templates', 'page.pt')
+
+def make_args(count):
+  return [{'page': {'title': 'Page %d' % i, 'body': 'Body of page %d' % i}} for i in range(count)]
+
+def bench_eval(args_list):
+  start = time.perf_counter()
+  for args in args_list:
+    PT.eval(TEMPLATE, args)
+  return time.perf_counter() - start
+
+def bench_compiled(args_list):
+  start = time.perf_counter()
+  PT.compile(TEMPLATE).render_batch(args_list)
+  return time.perf_counter() - start
+
+if __name__ == '__main__':
+  count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+  args_list = make_args(count)
+  print('%10s %8s %12s %12s' % ('method', 'renders', 'time(s)', 'renders/s'))
+  cost = bench_eval(args_list)
+  print('%10s %8d %12.3f %12d' % ('eval', count, cost, count / cost))
+  if hasattr(PT, 'compile'):
+    cost = bench_compiled(args_list)
+    print('%10s %8d %12.3f %12d' % ('compiled', count, cost, count / cost))
@@ -0,0 +1,40 @@
+#-*- coding: UTF-8 -*-
+# Render time of nested @include trees, the innermost template writes all lines.
+# Usage: python bench_include.py [pt_dir]
+#   pt_dir - the PT source directory to measure, defaults to the parent directory.
+#            Pass another checkout to compare before/after.
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ptctx import PT
+
+def make_templates(path, depth):
+  for level in range(depth):
+    with open(os.path.join(path, 'level%d.pt' % level), 'w') as fh:
+      fh.write('level %d {\n' % level)
+      fh.write("  {%% @include('level%d.pt', {'n': n}) %%}\n" % (level + 1))
+      fh.write('}\n')
+  with open(os.path.join(path, 'level%d.pt' % depth), 'w') as fh:
+    fh.write('{% for i in range(n) %}\nline {{ i }}\n{% endfor %}\n')
+  return os.path.join(path, 'level0.pt')
+
+def bench(path, depth, lines):
+  template = make_templates(path, depth)
+  start = time.perf_counter()
+  out = PT.eval(template, {'n': lines})
+  return len(out), time.perf_counter() - start
+
+if __name__ == '__main__':
+  path = tempfile.mkdtemp()
+  try:
+    print('%8s %8s %12s %12s' % ('depth', 'lines', 'time(s)', 'lines/s'))
+    for depth in [0, 1, 5, 10]:
+      lines = 50000
+      size, cost = bench(path, depth, lines)
+      print('%8d %8d %12.3f %12d' % (depth, lines, cost, lines / cost))
+  finally:
+    shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,33 @@
+#-*- coding: UTF-8 -*-
+# Peak RSS of tokenizing a large template, every measurement runs in a new process.
+# Usage: python bench_memory.py [pt_dir]
+#   pt_dir - the PT source directory to measure, defaults to the parent directory.
+#            Pass another checkout to compare before/after.
+import os
+import sys
+import resource
+import subprocess
+
+# bench_tokenizer imports ptctx from pt_dir
+from bench_tokenizer import ptctx, make_template
+
+def child(size):
+  text = make_template(size)
+  base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  tokenizer = ptctx.Tokenizer(text)
+  tokenizer.next_line()  # parse all lines
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  print(base, peak)
+
+if __name__ == '__main__':
+  if '-child' in sys.argv:
+    child(int(sys.argv[-1]))
+    sys.exit(0)
+
+  pt_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+  print('%12s %16s %16s' % ('size(KB)', 'peak RSS(MB)', 'tokens RSS(MB)'))
+  for size in [1024 * 1024, 5 * 1024 * 1024, 20 * 1024 * 1024]:
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), os.path.abspath(pt_dir), '-child', str(size)],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+    base, peak = [int(v) for v in out.split()]
+    print('%12d %16.1f %16.1f' % (size / 1024, peak / 1024, (peak - base) / 1024))
@@ -0,0 +1,27 @@
+#-*- coding: UTF-8 -*-
+# Render time vs output size.
+# Usage: python bench_output.py [pt_dir]
+#   pt_dir - the PT source directory to measure, defaults to the parent directory.
+#            Pass another checkout to compare before/after.
+import os
+import sys
+import time
+
+sys.path.insert(0, sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ptctx import PT
+
+TEMPLATE = '''{% for i in range(n) %}
+line {{ i }}: ''' + 'x' * 88 + '''
+{% endfor %}
+'''
+
+def bench(lines):
+  start = time.perf_counter()
+  out = PT.eval(TEMPLATE, {'n': lines})
+  return len(out), time.perf_counter() - start
+
+if __name__ == '__main__':
+  print('%12s %12s %12s' % ('output(KB)', 'time(s)', 'MB/s'))
+  for lines in [1000, 10000, 20000, 50000, 100000]:
+    size, cost = bench(lines)
+    print('%12d %12.3f %12.2f' % (size / 1024, cost, size / 1024 / 1024 / cost))
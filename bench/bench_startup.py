@@ -0,0 +1,65 @@
+#-*- coding: UTF-8 -*-
+# Cold start time of the command line: the import time of ptctx (python -X importtime) and the
+# wall time of rendering a small template by "python pt", every run is a new process.
+# Usage: python bench_startup.py [pt_dir] [runs]
+#   pt_dir - the PT source directory to measure, defaults to the parent directory.
+#            Pass another checkout to compare before/after.
+#   runs   - the number of processes of every measurement, defaults to 20.
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+def import_times(pt_dir, env):
+  # Return the total import time of ptctx and the modules it imports, in microseconds
+  out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import sys; sys.path.insert(0, %r); import ptctx' % pt_dir],
+                       env=env, stderr=subprocess.PIPE, check=True).stderr.decode('utf-8')
+  modules, total = [], 0
+  for line in out.splitlines():
+    if not line.startswith('import time:') or 'cumulative' in line:
+      continue
+    self_us, cumulative_us, name = line[len('import time:'):].split('|')
+    modules.append((int(self_us), name.rstrip()))
+    if name.strip() == 'ptctx':
+      total = int(cumulative_us)
+  return total, modules
+
+def run_time(args, env):
+  start = time.perf_counter()
+  subprocess.run([sys.executable] + args, env=env, stdout=subprocess.DEVNULL, check=True)
+  return time.perf_counter() - start
+
+if __name__ == '__main__':
+  pt_dir = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+  runs = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+  # The byte code is cached out of the source tree, as an installed PT would have it
+  path = tempfile.mkdtemp()
+  env = dict(os.environ)
+  env.pop('PYTHONDONTWRITEBYTECODE', None)
+  env.pop('PT_CACHE_DIR', None)
+  env['PYTHONPYCACHEPREFIX'] = os.path.join(path, 'pycache')
+  template = os.path.join(path, 'hello.pt')
+  with open(template, 'w') as fh:
+    fh.write('{% for i in range(3) %}\nHello {{ i }}\n{% endfor %}\n')
+
+  try:
+    run_time([pt_dir, '-nologo', '-nocosttime', template], env)  # write the byte code
+    totals, modules = [], None
+    for i in range(runs):
+      total, modules = import_times(pt_dir, env)
+      totals.append(total)
+    cli = sorted(run_time([pt_dir, '-nologo', '-nocosttime', template], env) for i in range(runs))
+    python = sorted(run_time(['-c', 'pass'], env) for i in range(runs))  # the interpreter start only
+
+    totals.sort()
+    print('import ptctx (median of %d): %8.2f ms' % (runs, totals[len(totals) // 2] / 1000.0))
+    print('python pt    (median of %d): %8.2f ms' % (runs, cli[len(cli) // 2] * 1000))
+    print('python -c "" (median of %d): %8.2f ms' % (runs, python[len(python) // 2] * 1000))
+    print('Slowest imports (self time):')
+    for self_us, name in sorted(modules, reverse=True)[:10]:
+      print('  %8.2f ms %s' % (self_us / 1000.0, name))
+  finally:
+    shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,276 @@
+#-*- coding: UTF-8 -*-
+# Benchmark suite of the tokenizer, translation, expressions, loops, includes and data loaders.
+# Every case runs in a new process, the samples, latency percentiles, throughput and peak RSS are
+# written into a JSON file.
+# Usage: python bench_suite.py [pt_dir] [-out <file>] [-repeat <n>] [-scale <f>] [-only <case,...>]
+#          pt_dir  - the PT source directory to measure, defaults to the parent directory.
+#          -out    - the JSON result file, defaults to bench_result.json.
+#          -repeat - the number of samples of every case, defaults to 5.
+#          -scale  - the multiple of the default input sizes, defaults to 1.
+#          -only   - run the listed cases only.
+#        python bench_suite.py -compare <old result> <new result>
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import platform
+import resource
+import tempfile
+import subprocess
+
+# ---------------------------------------------------------------- Generators
+
+def gen_text_template(size):
+  lines = [
+    'plain text line with some words, numbers 123 and (punctuation).\n',
+    '    <li><a href="{{ item.url }}">{{ item.title | self.upper() }}</a></li>\n',
+    '{% for item in items %}\n',
+    '{% endfor %}\n',
+  ]
+  out, length = [], 0
+  while length < size:
+    for line in lines:
+      out.append(line)
+      length += len(line)
+  return ''.join(out)
+
+def gen_loop_template():
+  return '''{% for row in rows %}
+<tr class="{{ row_idx % 2 == 0 ? 'even' : 'odd' }}">
+  {% for cell in row['cells'] %}
+  <td>{{ cell.name | self.upper() }}={{ cell.value }}</td>
+  {% endfor %}
+</tr>
+{% endfor %}
+'''
+
+def gen_rows(rows, cols):
+  return [{'cells': [{'name': 'c%d' % c, 'value': r * cols + c} for c in range(cols)]} for r in range(rows)]
+
+def gen_include_templates(path, fanout, lines):
+  for i in range(fanout):
+    with open(os.path.join(path, 'child%d.pt' % i), 'w') as fh:
+      fh.write('child %d of {{ parent }}\n' % i)
+      fh.write('{%% for i in range(%d) %%}\n  line {{ i }}\n{%% endfor %%}\n' % lines)
+  root = os.path.join(path, 'root.pt')
+  with open(root, 'w') as fh:
+    fh.write('{%% for i in range(%d) %%}\n' % fanout)
+    fh.write("  {% @include('child' + str(i) + '.pt', {'parent': 'root'}) %}\n")
+    fh.write('{% endfor %}\n')
+  return root
+
+def gen_records(count):
+  return [{'id': i, 'name': 'name %d' % i, 'score': i % 100, 'city': 'city %d' % (i % 50)} for i in range(count)]
+
+def gen_json(path, count):
+  file = os.path.join(path, 'data.json')
+  with open(file, 'w') as fh:
+    json.dump({'records': gen_records(count)}, fh)
+  return file
+
+def gen_xml(path, count):
+  file = os.path.join(path, 'data.xml')
+  with open(file, 'w') as fh:
+    fh.write('<records>\n')
+    for r in gen_records(count):
+      fh.write('  <record id="%d"><name>%s</name><score>%d</score><city>%s</city></record>\n' %
+               (r['id'], r['name'], r['score'], r['city']))
+    fh.write('</records>\n')
+  return file
+
+def gen_yaml(path, count):
+  file = os.path.join(path, 'data.yaml')
+  with open(file, 'w') as fh:
+    fh.write('records:\n')
+    for r in gen_records(count):
+      fh.write('  - id: %d\n    name: %s\n    score: %d\n    city: %s\n' % (r['id'], r['name'], r['score'], r['city']))
+  return file
+
+def gen_sqlite(path, count):
+  file = os.path.join(path, 'data.db')
+  conn = sqlite3.connect(file)
+  conn.execute('CREATE TABLE records (id INTEGER, name TEXT, score INTEGER, city TEXT)')
+  conn.executemany('INSERT INTO records VALUES (?, ?, ?, ?)',
+                   [(r['id'], r['name'], r['score'], r['city']) for r in gen_records(count)])
+  conn.commit()
+  conn.close()
+  return file
+
+# ---------------------------------------------------------------- Cases
+# A case gets (ptctx, work directory, scale) and returns (run, units, unit name), run() is measured.
+
+def case_tokenize(ptctx, path, scale):
+  text = gen_text_template(int(2 * 1024 * 1024 * scale))
+  def run():
+    tokenizer = ptctx.Tokenizer(text)
+    while tokenizer.next_line() is not None:
+      pass
+  return run, len(text), 'bytes'
+
+def case_translate(ptctx, path, scale):
+  text = gen_text_template(int(512 * 1024 * scale))
+  def run():
+    ctx = ptctx._PTCtx(text)
+    ctx.compile() if hasattr(ctx, 'compile') else ctx._translate()
+  return run, len(text), 'bytes'
+
+def case_expressions(ptctx, path, scale):
+  count = int(20000 * scale)
+  template = '''{% for r in records %}
+{{ r.name | self.upper() }} {{ r.score >= 60 ? 'pass' : 'fail' }} {{ r['city'] }} {{ len(r.name) + r.id }}
+{% endfor %}
+'''
+  args = {'records': gen_records(count)}
+  return lambda: ptctx.PT.eval(template, args), count * 4, 'expressions'
+
+def case_loops(ptctx, path, scale):
+  rows, cols = int(2000 * scale), 20
+  template, args = gen_loop_template(), {'rows': gen_rows(rows, cols)}
+  return lambda: ptctx.PT.eval(template, args), rows * cols, 'cells'
+
+def case_include_fanout(ptctx, path, scale):
+  fanout = int(500 * scale)
+  root = gen_include_templates(path, fanout, 20)
+  return lambda: ptctx.PT.eval(root), fanout, 'includes'
+
+def case_data_json(ptctx, path, scale):
+  count = int(50000 * scale)
+  file = gen_json(path, count)
+  return lambda: ptctx.ptutil.data_json(file), count, 'records'
+
+def case_data_xml(ptctx, path, scale):
+  count = int(20000 * scale)
+  file = gen_xml(path, count)
+  return lambda: ptctx.ptutil.data_xml(file), count, 'records'
+
+def case_data_yaml(ptctx, path, scale):
+  count = int(20000 * scale)
+  file = gen_yaml(path, count)
+  return lambda: ptctx.ptutil.data_yaml(file), count, 'records'
+
+def case_data_sqlite(ptctx, path, scale):
+  count = int(50000 * scale)
+  file = gen_sqlite(path, count)
+  def run():
+    rows = ptctx.ptutil.data_sqlite(file, 'SELECT * FROM records')
+    for row in rows:
+      pass
+  return run, count, 'records'
+
+CASES = [
+  ('tokenize', case_tokenize),
+  ('translate', case_translate),
+  ('expressions', case_expressions),
+  ('loops', case_loops),
+  ('include_fanout', case_include_fanout),
+  ('data_json', case_data_json),
+  ('data_xml', case_data_xml),
+  ('data_yaml', case_data_yaml),
+  ('data_sqlite', case_data_sqlite),
+]
+
+# ---------------------------------------------------------------- Runner
+
+def percentile(samples, p):
+  samples = sorted(samples)
+  return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+def child(pt_dir, name, repeat, scale):
+  sys.path.insert(0, pt_dir)
+  import ptctx
+  if hasattr(ptctx.PT, 'set_cache_dir'):
+    ptctx.PT.set_cache_dir(None)
+
+  path = tempfile.mkdtemp()
+  try:
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run, units, unit = dict(CASES)[name](ptctx, path, scale)
+    samples = []
+    for i in range(repeat):
+      gc.collect()
+      start = time.perf_counter()
+      run()
+      samples.append(time.perf_counter() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  finally:
+    shutil.rmtree(path, ignore_errors=True)
+
+  p50 = percentile(samples, 50)
+  print(json.dumps({
+    'units': units,
+    'unit': unit,
+    'samples': samples,
+    'p50': p50,
+    'p90': percentile(samples, 90),
+    'p99': percentile(samples, 99),
+    'throughput': units / p50,
+    'peak_rss_mb': peak / 1024.0,
+    'base_rss_mb': base / 1024.0,
+  }))
+
+def run_suite(pt_dir, out_file, repeat, scale, only):
+  result = {
+    'pt_dir': pt_dir,
+    'python': sys.version.split()[0],
+    'platform': platform.platform(),
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'repeat': repeat,
+    'scale': scale,
+    'cases': {},
+  }
+  env = dict(os.environ)
+  env.pop('PT_CACHE_DIR', None)
+  print('%16s %12s %12s %12s %16s %12s' % ('case', 'p50(s)', 'p90(s)', 'p99(s)', 'throughput/s', 'peak(MB)'))
+  for name, _ in CASES:
+    if only and name not in only:
+      continue
+    try:
+      out = subprocess.check_output([sys.executable, os.path.abspath(__file__), pt_dir, '-child', name, str(repeat), str(scale)],
+                                    env=env, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as ex:
+      print('%16s FAILED: %s' % (name, ex.output.decode('utf-8', 'replace').strip().splitlines()[-1:]))
+      continue
+    case = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    result['cases'][name] = case
+    print('%16s %12.4f %12.4f %12.4f %16.0f %12.1f' %
+          (name, case['p50'], case['p90'], case['p99'], case['throughput'], case['peak_rss_mb']))
+
+  with open(out_file, 'w') as fh:
+    json.dump(result, fh, indent=2)
+  print('Result: ' + out_file)
+
+def compare(old_file, new_file):
+  with open(old_file) as fh:
+    old = json.load(fh)
+  with open(new_file) as fh:
+    new = json.load(fh)
+  print('%16s %12s %12s %10s %12s %12s' % ('case', 'old p50(s)', 'new p50(s)', 'speedup', 'old MB', 'new MB'))
+  for name, new_case in new['cases'].items():
+    old_case = old['cases'].get(name)
+    if old_case is None:
+      print('%16s %12s %12.4f' % (name, '-', new_case['p50']))
+      continue
+    print('%16s %12.4f %12.4f %9.2fx %12.1f %12.1f' % (name, old_case['p50'], new_case['p50'], old_case['p50'] / new_case['p50'],
+                                                       old_case['peak_rss_mb'], new_case['peak_rss_mb']))
+
+if __name__ == '__main__':
+  argv = sys.argv[1:]
+  if len(argv) > 0 and argv[0] == '-compare':
+    compare(argv[1], argv[2])
+    sys.exit(0)
+
+  pt_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+  if len(argv) > 0 and not argv[0].startswith('-'):
+    pt_dir = argv.pop(0)
+  pt_dir = os.path.abspath(pt_dir)
+
+  if len(argv) > 0 and argv[0] == '-child':
+    child(pt_dir, argv[1], int(argv[2]), float(argv[3]))
+    sys.exit(0)
+
+  options = dict(zip(argv[0::2], argv[1::2]))
+  run_suite(pt_dir, options.get('-out', 'bench_result.json'), int(options.get('-repeat', 5)),
+            float(options.get('-scale', 1)), options['-only'].split(',') if '-only' in options else None)
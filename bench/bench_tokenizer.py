@@ -0,0 +1,41 @@
+#-*- coding: UTF-8 -*-
+# Tokenize time of a large template by Tokenizer and CharTokenizer.
+# Usage: python bench_tokenizer.py [pt_dir]
+#   pt_dir - the PT source directory to measure, defaults to the parent directory.
+#            Pass another checkout to compare before/after.
+import os
+import sys
+import time
+
+sys.path.insert(0, sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ptctx
+
+LINES = [
+  'plain text line with some words, numbers 123 and (punctuation).\n',
+  '    <li><a href="{{ item.url }}">{{ item.title | self.upper() }}</a></li>\n',
+  '{% for item in items %}\n',
+  '{% endfor %}\n',
+]
+
+def make_template(size):
+  lines = []
+  length = 0
+  while length < size:
+    for line in LINES:
+      lines.append(line)
+      length += len(line)
+  return ''.join(lines)
+
+def bench(cls, text):
+  start = time.perf_counter()
+  tokenizer = cls(text)
+  while tokenizer.next_line() is not None:
+    pass
+  return time.perf_counter() - start
+
+if __name__ == '__main__':
+  classes = [getattr(ptctx, name) for name in ['Tokenizer', 'CharTokenizer'] if hasattr(ptctx, name)]
+  print('%12s' % 'size(KB)' + ''.join('%16s' % cls.__name__ for cls in classes))
+  for size in [100 * 1024, 1024 * 1024, 5 * 1024 * 1024]:
+    text = make_template(size)
+    print('%12d' % (len(text) / 1024) + ''.join('%15.3fs' % bench(cls, text) for cls in classes))
@@ -0,0 +1,63 @@
+#-*- coding: UTF-8 -*-
+# Time and peak RSS of loading a large XML file by data_xml (and iterating it by data_xml_nodes),
+# every measurement runs in a new process.
+# Usage: python bench_xml.py [pt_dir] [size]
+#   pt_dir - the PT source directory to measure, defaults to the parent directory.
+#            Pass another checkout to compare before/after.
+#   size   - the size of the XML file in MB, defaults to 100.
+import os
+import sys
+import time
+import resource
+import tempfile
+import subprocess
+
+def make_xml(file, size):
+  item = ('<item id="%d" type="t%d"><name>item %d</name><price>%d.5</price>'
+          '<labels><label>a</label><label>b</label></labels><desc>description of the item %d</desc></item>\n')
+  with open(file, 'w') as fh:
+    fh.write('<root>\n<list>\n')
+    i, length = 0, 0
+    while length < size:
+      line = item % (i, i % 7, i, i, i)
+      fh.write(line)
+      length += len(line)
+      i += 1
+    fh.write('</list>\n</root>\n')
+  return i
+
+def child(loader, file):
+  sys.path.insert(0, sys.argv[1])
+  import ptutil
+  base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  start = time.perf_counter()
+  if loader == 'data_xml':
+    count = len(ptutil.data_xml(file).list.item)
+  else:
+    count = sum(1 for item in ptutil.data_xml_nodes(file, 'list/item'))
+  cost = time.perf_counter() - start
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  print(count, cost, base, peak)
+
+if __name__ == '__main__':
+  if '-child' in sys.argv:
+    child(sys.argv[-2], sys.argv[-1])
+    sys.exit(0)
+
+  pt_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+  size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+  file = os.path.join(tempfile.gettempdir(), 'pt-bench-%d.xml' % os.getpid())
+  try:
+    items = make_xml(file, size * 1024 * 1024)
+    print('%d MB, %d items' % (size, items))
+    print('%16s %10s %16s' % ('loader', 'time(s)', 'peak RSS(MB)'))
+    for loader in ['data_xml', 'data_xml_nodes']:
+      out = subprocess.run([sys.executable, os.path.abspath(__file__), os.path.abspath(pt_dir), '-child', loader, file],
+                           capture_output=True, text=True)
+      if out.returncode != 0:
+        print('%16s %10s %s' % (loader, 'failed', out.stderr.strip().splitlines()[-1:]))
+        continue
+      count, cost, base, peak = out.stdout.split()
+      print('%16s %10.2f %16.1f' % (loader, float(cost), int(peak) / 1024))
+  finally:
+    os.remove(file)
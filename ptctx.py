@@ -1,35 +1,209 @@
 import collections
+import itertools
 import os
+import re
+import sys
+import marshal
+import queue
+import threading
+import time
+import types
 import ptutil
-import inspect
+# ast, hashlib, linecache and concurrent.futures are imported on the first use to speed up the start
+
+PT_VERSION = '2.0.0'
 
 LOG_ERROR = 0
 LOG_INFO  = 1
 LOG_DEBUG = 2
 
+def _pt_pipe_call(func, val):
+  return func(val) if callable(func) else func
+
+def _pt_prp(val, prp):
+  # dic.key - get the value by the key if 'val' has no such non-callable attribute
+  attr = getattr(val, prp, None)
+  if attr is not None and not callable(attr):
+    return attr
+  try:
+    return val[prp]
+  except Exception:
+    return getattr(val, prp)
+
+def _pt_raise(ex):
+  raise ex
+
+_PureCacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+class _PureCache:
+  # The LRU cache of the results of a pure function, it keeps no reference to the function
+  def __init__(self, qualname, maxsize):
+    self.qualname = qualname
+    self.maxsize = maxsize
+    self.results = collections.OrderedDict()
+    self.hits = self.misses = 0
+
+  def cache_info(self):
+    return _PureCacheInfo(self.hits, self.misses, self.maxsize, len(self.results))
+
+class _PureFunction:
+  # A function whose results only depend on its arguments, the results are kept in the shared cache
+  def __init__(self, func, cache):
+    import functools
+    self.func = func
+    self._cache = cache
+    functools.update_wrapper(self, func)
+
+  def __call__(self, *args, **kwargs):
+    cache = self._cache
+    key = args + (_PureFunction,) + tuple(kwargs.items()) if kwargs else args
+    try:
+      ret = cache.results[key]
+    except KeyError:
+      pass
+    except TypeError:
+      return self.func(*args, **kwargs)  # the unhashable arguments are not cached
+    else:
+      cache.hits += 1
+      cache.results.move_to_end(key)
+      return ret
+    cache.misses += 1
+    ret = cache.results[key] = self.func(*args, **kwargs)
+    if len(cache.results) > cache.maxsize:
+      cache.results.popitem(False)
+    return ret
+
+  def cache_info(self):
+    return self._cache.cache_info()
+
+# The caches of the @pure functions of the current render in this thread: (code object, closure values)
+# or the builtin function -> _PureCache. The templates and includes may define a function again, the
+# functions of the same code and closure share the cache, but every definition calls its own function.
+# The caches are dropped at the end of the render, the globals of the functions are not a part of the key.
+_pure_scope = threading.local()
+
+def _cell_value(cell):
+  try:
+    return cell.cell_contents
+  except ValueError:
+    return _PureCache  # the empty cell, such as the decorated function itself
+
+def pure(func=None, maxsize=1024):
+  # Decorator of the extension functions: @pure or @pure(maxsize=n)
+  if func is None:
+    return lambda func: pure(func, maxsize)
+  functions = getattr(_pure_scope, 'functions', None)
+  if functions is None:
+    return _PureFunction(func, _PureCache(func.__qualname__, maxsize))  # not in a render
+  code = getattr(func, '__code__', None)
+  key = func if code is None else (code, tuple(_cell_value(cell) for cell in func.__closure__ or ()))
+  try:
+    cache = functions.get(key)
+  except TypeError:
+    return _PureFunction(func, _PureCache(func.__qualname__, maxsize))  # an unhashable closure value
+  if cache is None or cache.maxsize != maxsize:
+    cache = functions[key] = _PureCache(func.__qualname__, maxsize)
+  return _PureFunction(func, cache)
+
+# The file names of the recently used text templates, only their lines are kept in linecache
+_template_names = collections.OrderedDict()
+_TEMPLATE_NAMES_MAX = 256
+
+def _template_filename(template):
+  # The file name of the template code objects, the text templates are registered in linecache for tracebacks
+  if os.path.isfile(template):
+    return os.path.realpath(template)
+  import linecache
+  filename = _template_names.get(template)
+  if filename is None:
+    import hashlib
+    filename = _template_names[template] = '<template %s>' % hashlib.sha256(template.encode('utf-8')).hexdigest()[:16]
+    if len(_template_names) > _TEMPLATE_NAMES_MAX:
+      linecache.cache.pop(_template_names.popitem(last=False)[1], None)
+  else:
+    try:
+      _template_names.move_to_end(template)
+    except KeyError:
+      pass  # dropped by another thread
+  if filename not in linecache.cache:
+    linecache.cache[filename] = (len(template), None, template.splitlines(True), filename)
+  return filename
+
+def _relocate(tree, lines, shifts):
+  # Move the ast nodes to the template coordinates, lines[lineno - 1] and shifts[lineno - 1] are the
+  # template line and the column shift of the generated line
+  import ast
+  AST = ast.AST
+  nodes = [tree]
+  pop, push, extend = nodes.pop, nodes.append, nodes.extend
+  while nodes:
+    node = pop()
+    for field in node._fields:
+      value = getattr(node, field, None)
+      if type(value) is list:
+        extend([v for v in value if isinstance(v, AST)])
+      elif isinstance(value, AST):
+        push(value)
+    if 'lineno' in node._attributes:
+      lineno, end_lineno = node.lineno - 1, node.end_lineno - 1
+      node.lineno = lines[lineno]
+      node.col_offset = max(0, node.col_offset + shifts[lineno])
+      node.end_lineno = lines[end_lineno]
+      node.end_col_offset = max(0, node.end_col_offset + shifts[end_lineno])
+
 class PT:
   @staticmethod
   def execute(argv):
     usage = '''
 python pt <template> [options] 
+python pt serve|stop [socket]   Start/stop the render server on the Unix socket (default: $PT_SOCKET or
+                                <temp dir>/pt-<uid>.sock), it keeps the compiled templates and extensions.
 options：
   -nologo                 Suppress the display of the logo.
+  -server <socket>        Render by the render server, "" for the default socket.
+                          Not with -cache, -nocache (the server uses $PT_CACHE_DIR) or -watch.
   -nocosttime             Do not show execution time.
+  -cache <dir>            Cache the translated templates in the directory.
+  -nocache                Disable the template cache (including $PT_CACHE_DIR).
   -out  <file>            Specify the output file, otherwise the output will be written to stdout.
   -ext  <path>            Specify a Python file or a directory containing Python files for extension.
   -args <dict>            Define variables using a Python dictionary.
   -ini  <name=file>       Load variables from an INI file.
   -json <name=file>       Load variables from a JSON file.
   -xml  <name=file>       Load variables from an XML file.
+  -xmlnodes <name=file,path>
+                          Iterate the elements of a large XML file which match the path (e.g. items/item),
+                          the file is parsed for every loop and only the current element is kept in memory.
   -yaml <name=file>       Load variables from a YAML file.
   -kv   <name=file>       Load variables from a Key-Value file.
   -sql  <name=file,query> Load variables from a SQLite file.
+  -sqlrows <name=file,query>
+                          Iterate the rows of a SQLite query lazily, the query runs for every loop.
+  -sqlfile <file>         The named queries of the following -sql/-sqlrows options, a query is the SQL after
+                          a "-- name: <query>" line of the file. The variables defined before bind the
+                          :name parameters of the queries.
+  -sqlmode <mode>         Open the SQLite files of the following -sql/-sqlrows options in the mode:
+                            rw - read-write (default)
+                            ro - read-only, with a 256 MB mmap
+                            immutable - read-only and the files do not change while rendering
+  -batch <file>           Render the template for every job in the JSON file:
+                            [{"args": {...}, "out": "file", "template": "optional template"}, ...]
+  -jobs <n>               Number of processes to render the -batch jobs (default: CPU count).
+  -profile <file>         Print the time of the template lines, expressions and includes,
+                          and write the collapsed stacks (flamegraph) to the file, "-" for no file.
+  -watch <seconds>        Render, then poll the template, include, extension and data files every <seconds>
+                          and render again the outputs whose files changed (Ctrl+C to stop).
   -log  <level>           Set log level:
                             0 - ERROR
                             1 - INFO (default)
                             2 - DEBUG
 '''
 
+    if '-watch' in argv:
+      idx = argv.index('-watch')
+      if idx + 1 < len(argv):
+        return PT._watch(argv[:idx] + argv[idx + 2:], float(argv[idx + 1]))
+
     try:
       argc = len(argv)
       if (argc < 2):
@@ -43,12 +217,10 @@ options：
         print(usage)
         return
 
-      # import all functions in ptutils into globals(), so they can be used in the template.
-      for fname, obj in inspect.getmembers(ptutil, inspect.isfunction):
-        if not fname.startswith('_'):
-          globals()[fname] = obj
-
       ctx = _PTCtx(template_file)
+      variables = {}
+      batch_file, processes, profile, out_file = None, None, None, None
+      sql_queries, sql_mode = None, 'rw'
 
       if argc > 2:
         if argc % 2 != 0:
@@ -63,47 +235,262 @@ options：
           option, val = argv[i], argv[i + 1]
 
           if option == '-out':
-            ctx.output_file(val, True)
+            out_file = val  # opened after all options are loaded, a failed option leaves no file
           elif option == '-args':
-            ctx.variables(eval(val))
+            variables.update(eval(val))
           elif option == '-ini':
             name, ini_file = PT._split_name_value(val)
-            ctx.variables({name: ptutil.data_ini(ini_file)})
+            _depend(ini_file)
+            variables.update({name: ptutil.data_ini(ini_file)})
           elif option == '-json':
             name, json_file = PT._split_name_value(val)
-            ctx.variables({name: ptutil.data_json(json_file)})
+            _depend(json_file)
+            variables.update({name: ptutil.data_json(json_file)})
           elif option == '-xml':
             name, xml_file = PT._split_name_value(val)
-            ctx.variables( {name: ptutil.data_xml(xml_file)} )
+            _depend(xml_file)
+            variables.update( {name: ptutil.data_xml(xml_file)} )
+          elif option == '-xmlnodes':
+            name, xml_val = PT._split_name_value(val)
+            xml_file, xml_path = PT._split_name_value(xml_val, ',')
+            _depend(xml_file)
+            variables.update({name: ptutil.data_xml_nodes(xml_file, xml_path)})
           elif option == '-yaml':
             name, yaml_file = PT._split_name_value(val)
-            ctx.variables( {name: ptutil.data_yaml(yaml_file)} )
+            _depend(yaml_file)
+            variables.update( {name: ptutil.data_yaml(yaml_file)} )
           elif option == '-kv':
             name, kv_file = PT._split_name_value(val)
-            ctx.variables( {name: ptutil.data_KV(kv_file)} )
-          elif option == '-sql':
+            _depend(kv_file)
+            variables.update( {name: ptutil.data_KV(kv_file)} )
+          elif option == '-sql' or option == '-sqlrows':
             name, sql_val = PT._split_name_value(val)
             sql_file, sql_query = PT._split_name_value(sql_val, ',')
-            ctx.variables({name: ptutil.data_sqlite(sql_file, sql_query)})
+            _depend(sql_file)
+            if sql_queries is not None:
+              sql_query = ptutil.sql_queries(sql_queries).get(sql_query, sql_query)
+            # The variables are bound to the named parameters, a query of '?' parameters gets none
+            params = dict(variables) if PT._SQL_NAMED_PARAM.search(sql_query) else ()
+            variables.update({name: ptutil.data_sqlite(sql_file, sql_query, option == '-sqlrows', params, None, sql_mode)})
+          elif option == '-sqlfile':
+            sql_queries = val
+            _depend(sql_queries)
+          elif option == '-sqlmode':
+            sql_mode = val
           elif option == '-ext':
+            if '-batch' in argv:
+              raise SyntaxError('The option "-ext" can not be used with "-batch", use "@extension" in the template.')
             ctx.extension(val, True)
+          elif option == '-batch':
+            batch_file = val
+            _depend(batch_file)
+          elif option == '-jobs':
+            processes = int(val)
+          elif option == '-profile':
+            profile = True if val == '-' else val
           elif option == '-log':
             ctx.log_level = int(val)
           else:
             raise SyntaxError('Invalid option "%s".' % option)
-      out_text = ctx.eval()
-      if len(out_text.strip()) > 0: print(out_text)
+      ctx.variables(variables)
+
+      if batch_file is not None:
+        PT._execute_batch(template_file, batch_file, variables, processes)
+        return
+      if out_file is not None:
+        ctx.output_file(out_file, True)
+
+      if profile is not None:
+        ctx._profiler = _Profiler()
+        out = ctx.eval()
+        if len(out.strip()) > 0:
+          print(out)
+        PT._profile_report(ctx._profiler, profile)
+        return
+
+      # Stream the output to stdout, so the first bytes appear before the whole template is rendered.
+      # The output is not printed if it only contains blanks.
+      blanks, printed = '', False
+      for chunk in ctx.stream(8192):
+        if not printed:
+          blanks += chunk
+          if len(blanks.strip()) == 0:
+            continue
+          chunk, printed = blanks, True
+        sys.stdout.write(chunk)
+        sys.stdout.flush()
+      if printed: print()
 
     except Exception as err:
       print(str(err))
       print(usage)
+    finally:
+      ptutil.sqlite_close()
 
   @staticmethod
-  def eval(template, args={}, output_file=None, debug=False):
+  def eval(template, args={}, output_file=None, debug=False, profile=False):
+    # profile: True - print the profile report, <file> - also write the collapsed stacks to the file
     ctx = _PTCtx(template, args, output_file)
     if debug:
       ctx.log_level = LOG_DEBUG
-    return ctx.eval()
+    if not profile:
+      return ctx.eval()
+
+    ctx._profiler = _Profiler()
+    ret = ctx.eval()
+    PT._profile_report(ctx._profiler, profile)
+    return ret
+
+  @staticmethod
+  def _profile_report(profiler, profile):
+    print(profiler.report())
+    if profile is not True:
+      profiler.write_stacks(profile)
+
+  @staticmethod
+  def compile(template):
+    # Translate the template once, the returned object renders it with different arguments
+    return _PTTemplate(template)
+
+  @staticmethod
+  def render_many(jobs, processes=None, start_method=None):
+    # Render the (template, args, output_file) jobs by a process pool (processes=None: CPU count).
+    # Return the (output, error) of every job in order, the error is None if the job succeeded.
+    # start_method: 'fork', 'spawn' or 'forkserver' to start the workers, None for the default.
+    jobs = [tuple(job) for job in jobs]
+
+    # Translate every template once, the workers share the compiled templates
+    templates = {}
+    for job in jobs:
+      if job[0] not in templates:
+        try:
+          templates[job[0]] = _PTCtx(job[0]).compile()
+        except Exception:
+          pass  # The error is reported by the jobs of the template
+
+    if processes == 1 or len(jobs) <= 1:
+      return [_render_job(job, templates)[0] for job in jobs]
+
+    import concurrent.futures
+    import multiprocessing
+    payload = marshal.dumps(templates)
+    processes = processes or os.cpu_count() or 1
+    context = multiprocessing.get_context(start_method)
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(processes, context, _render_jobs_init, (payload,)) as executor:
+      futures = [executor.submit(_render_job, job) for job in jobs]
+      for future in futures:
+        # A job that cannot be pickled or a broken pool fails the job, not the whole batch
+        try:
+          result, counts = future.result()
+        except Exception as ex:
+          result, counts = (None, type(ex).__name__ + ': ' + str(ex)), (0, 0)
+        # The output files are counted in the worker processes, sum them here
+        _OutputFile.written += counts[0]
+        _OutputFile.unchanged += counts[1]
+        results.append(result)
+    return results
+
+  @staticmethod
+  def _execute_batch(template_file, batch_file, variables, processes):
+    jobs = []
+    for item in ptutil.data_json(batch_file):
+      args = dict(variables)
+      args.update(item.get('args', {}))
+      out = item.get('out')
+      jobs.append((item.get('template', template_file), args, os.path.abspath(out) if out else None))
+
+    if _watch_jobs is not None:
+      # Watching: render in this process to record the dependencies of every job
+      results = []
+      for job in jobs:
+        result, stamps = PT._render_tracked(job)
+        _watch_jobs.append([len(_watch_jobs), job, stamps])
+        results.append(result)
+    else:
+      results = PT.render_many(jobs, processes)
+
+    failed = 0
+    for i, result in enumerate(results):
+      failed += PT._print_job_result(i, jobs[i], result)
+    print('[INFO ] %d jobs rendered, %d failed.' % (len(jobs), failed))
+
+  @staticmethod
+  def _print_job_result(i, job, result):
+    out_text, err = result
+    if err is not None:
+      print('[ERROR] Job %d "%s": %s' % (i, job[0], err))
+      return 1
+    if len(out_text.strip()) > 0:
+      print(out_text)
+    return 0
+
+  @staticmethod
+  def _render_tracked(job):
+    # Render the job in this process, return the result and the stamps of the files it read
+    global _dependencies
+    saved, _dependencies = _dependencies, set()
+    try:
+      return _render_job(job, {})[0], _stamps(_dependencies)
+    finally:
+      _dependencies = saved
+
+  @staticmethod
+  def _watch(argv, interval):
+    # Execute the command line, then poll the files it read. A changed batch job is rendered again
+    # alone, any other changed file executes the whole command line again.
+    global _dependencies, _watch_jobs
+    try:
+      while True:
+        _dependencies, _watch_jobs = set(), []
+        PT.execute(argv)
+        command, jobs = _stamps(_dependencies), _watch_jobs
+        _dependencies = _watch_jobs = None
+        files = set(command).union(*[stamps for i, job, stamps in jobs])
+        print('[INFO ] Watching %d files, press Ctrl+C to stop.' % len(files))
+        sys.stdout.flush()
+
+        while True:
+          time.sleep(interval)
+          changed = _changed(command)
+          if changed:
+            print('[INFO ] Changed: ' + ', '.join(changed))
+            break
+          for item in jobs:
+            changed = _changed(item[2])
+            if changed:
+              print('[INFO ] Changed: ' + ', '.join(changed))
+              result, item[2] = PT._render_tracked(item[1])
+              PT._print_job_result(item[0], item[1], result)
+          sys.stdout.flush()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      _dependencies = _watch_jobs = None
+
+  @staticmethod
+  def stream(template, args={}, output_file=None, chunk_size=16384):
+    # Yield the output in chunks while the template is rendered
+    ctx = _PTCtx(template, args, output_file)
+    return ctx.stream(chunk_size)
+
+  @staticmethod
+  def set_cache_dir(path):
+    # None disables the cache of translated templates
+    _code_cache.path = path if path else None
+
+  @staticmethod
+  def output_stats():
+    # (written, unchanged) output files
+    return _OutputFile.written, _OutputFile.unchanged
+
+  @staticmethod
+  def cache_stats():
+    if _code_cache.path is None:
+      return None
+    return _code_cache.hits, _code_cache.misses
+
+  _SQL_NAMED_PARAM = re.compile(r'[:@$][A-Za-z_]')
 
   @staticmethod
   def _split_name_value(val, sep='='):
@@ -112,14 +499,333 @@ options：
       raise SyntaxError(f'Can not find name separator "{sep}" in "{val}".')
     return val[0:pos].strip(), val[pos + 1:].strip()
 
+class _CodeCache:
+  # Translated templates are stored as marshalled (code, code object, expression table, line table),
+  # keyed by the template content, file name, PT version, cache format and Python version.
+  FORMAT = 4
+
+  def __init__(self):
+    self.path = os.environ.get('PT_CACHE_DIR') or None
+    self.hits = 0
+    self.misses = 0
+
+  def key(self, template, filename):
+    import hashlib
+    # The code objects contain the file name, so it is a part of the key
+    h = hashlib.sha256(('%s:%d:%s:%s:' % (PT_VERSION, _CodeCache.FORMAT, sys.implementation.cache_tag, filename)).encode('utf-8'))
+    if os.path.isfile(template):
+      with open(template, 'rb') as fh:
+        h.update(fh.read())
+    else:
+      h.update(template.encode('utf-8'))
+    return h.hexdigest()
+
+  def load(self, key):
+    try:
+      with open(self._file(key), 'rb') as fh:
+        ret = marshal.load(fh)
+      self.hits += 1
+      return ret
+    except Exception:
+      self.misses += 1
+      return None
+
+  def store(self, key, data):
+    file = self._file(key)
+    tmp_file = _tmp_file(file)
+    try:
+      ptutil.path_create(self.path)
+      with open(tmp_file, 'wb') as fh:
+        marshal.dump(data, fh)
+      os.replace(tmp_file, file)
+    except OSError:
+      if ptutil.file_exists(tmp_file):
+        ptutil.file_delete(tmp_file)
+
+  def _file(self, key):
+    return os.path.join(self.path, key + '.ptc')
+
+_code_cache = _CodeCache()
+
+class _OutputBuffer:
+  # Collect the text chunks and join them once, appending to a str is quadratic for large outputs
+  def __init__(self):
+    self._chunks = []
+    self.write = self._chunks.append
+
+  def getvalue(self):
+    if len(self._chunks) > 1:
+      self._chunks[:] = [''.join(self._chunks)]
+    return self._chunks[0] if len(self._chunks) > 0 else ''
+
+# Compiled file templates of this process: realpath -> ((mtime, size), (code, code object, expression table, line table))
+_compiled_templates = {}
+
+# Compiled extension files of this process: path -> ((mtime, size), code object)
+_compiled_extensions = {}
+
+# The files read by the renders of the watch mode (-watch), None if not watching
+_dependencies = None
+# The batch jobs of the watch mode and the stamps of their files: [[index, job, {file: stamp}], ...]
+_watch_jobs = None
+
+def _depend(file):
+  if _dependencies is not None and os.path.exists(file):
+    _dependencies.add(os.path.realpath(file))
+
+def _stamp(file):
+  try:
+    st = os.stat(file)
+    return st.st_mtime_ns, st.st_size
+  except OSError:
+    return None
+
+def _stamps(files):
+  return {file: _stamp(file) for file in files}
+
+def _changed(stamps):
+  return [file for file, stamp in stamps.items() if _stamp(file) != stamp]
+
+class _PTTemplate:
+  def __init__(self, template):
+    self._template = template
+    self._compiled = _PTCtx(template).compile()
+
+  @property
+  def code(self):
+    return self._compiled[0]
+
+  def render(self, args={}, output_file=None):
+    ctx = _PTCtx(self._template, args, output_file)
+    ctx._compiled = self._compiled
+    return ctx.eval()
+
+  def render_batch(self, args_list):
+    return [self.render(args) for args in args_list]
+
+class _Profiler:
+  # Calls and time of the template lines, expressions, includes and extensions.
+  # The time of a line includes the expressions and includes of the line.
+  def __init__(self):
+    self.stats = {}   # name: [calls, cumulative time, own time]
+    self.stacks = {}  # collapsed stack: own time
+    self._stack = []  # [name, start time, time of the children]
+    self._codes = {}  # code object: template name
+    self.pure_functions = {}  # the @pure caches of the render
+
+  def enter(self, name):
+    self._stack.append([name, time.perf_counter(), 0.0])
+
+  def exit(self):
+    name, start, children = self._stack.pop()
+    cost = time.perf_counter() - start
+    stat = self.stats.get(name)
+    if stat is None:
+      stat = self.stats[name] = [0, 0.0, 0.0]
+    stat[0] += 1
+    stat[1] += cost
+    stat[2] += cost - children
+    if self._stack:
+      self._stack[-1][2] += cost
+    stack = ';'.join([s[0].replace(';', ',') for s in self._stack] + [name.replace(';', ',')])
+    self.stacks[stack] = self.stacks.get(stack, 0.0) + cost - children
+
+  def run(self, ctx, code):
+    name = os.path.relpath(ctx._template) if os.path.isfile(ctx._template) else '<template>'
+    self._codes[code] = name
+    ctx.output_exp = self._wrap(ctx.output_exp, lambda exp_str: '%s {{ %s }}' % (name, exp_str))
+    ctx.include = self._wrap(ctx.include, lambda pt_file, *args: '@include ' + pt_file)
+    ctx.extension = self._wrap(ctx.extension, lambda py_file, *args: '@extension ' + py_file)
+
+    if ctx._parent is not None:
+      exec(code, ctx._g)  # the root context is tracing
+      return
+    trace = sys.gettrace()
+    sys.settrace(self._trace)
+    try:
+      exec(code, ctx._g)
+    finally:
+      sys.settrace(trace)
+
+  def report(self, limit=30):
+    rows = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+    lines = ['%8s %14s %10s  %s' % ('calls', 'cumulative(s)', 'own(s)', 'name')]
+    for name, (calls, cumulative, own) in rows:
+      lines.append('%8d %14.6f %10.6f  %s' % (calls, cumulative, own, name))
+
+    pure_lines = []
+    for cache in self.pure_functions.values():
+      if cache.hits + cache.misses > 0:
+        pure_lines.append('%8d %8d %8d  %s' % (cache.hits, cache.misses, len(cache.results), cache.qualname))
+    if pure_lines:
+      lines += ['', 'Pure functions:', '%8s %8s %8s  %s' % ('hits', 'misses', 'size', 'name')] + pure_lines
+    return '\n'.join(lines)
+
+  def write_stacks(self, file):
+    # The collapsed stack format of flamegraph.pl, the values are in microseconds
+    with open(file, 'w', encoding='utf-8') as fh:
+      for stack, cost in sorted(self.stacks.items()):
+        fh.write('%s %d\n' % (stack, round(cost * 1000000)))
+
+  def _wrap(self, func, name):
+    def profiled(*args):
+      self.enter(name(*args))
+      try:
+        return func(*args)
+      finally:
+        self.exit()
+    return profiled
+
+  def _trace(self, frame, event, arg):
+    name = self._codes.get(frame.f_code)
+    if name is None:
+      return None
+    current = [None]  # the template line which is measured
+
+    def trace_lines(frame, event, arg):
+      if event == 'line':
+        line = frame.f_lineno  # the code is compiled with the template lines
+        if line != current[0]:
+          if current[0] is not None:
+            self.exit()
+          current[0] = line
+          self.enter('%s:%d' % (name, line))
+      elif event == 'return' and current[0] is not None:
+        current[0] = None
+        self.exit()
+      return trace_lines
+    return trace_lines
+
+# The compiled templates of the render_many() worker process
+_job_templates = {}
+
+def _render_jobs_init(payload):
+  _job_templates.update(marshal.loads(payload))
+
+def _render_job(job, templates=_job_templates):
+  # Return the (output, error) of the job and the (written, unchanged) output files it counted
+  template, args, output_file = job
+  written, unchanged = _OutputFile.written, _OutputFile.unchanged
+  try:
+    ctx = _PTCtx(template, args, output_file)
+    ctx._compiled = templates.get(template)
+    result = ctx.eval(), None
+  except Exception as ex:
+    result = None, type(ex).__name__ + ': ' + str(ex)
+  return result, (_OutputFile.written - written, _OutputFile.unchanged - unchanged)
+
+# The temporary files of a process are numbered, the threads and contexts writing the same file
+# do not share a temporary file
+_tmp_ids = itertools.count()
+
+def _tmp_file(file):
+  return '%s.%d.%d.tmp' % (file, os.getpid(), next(_tmp_ids))
+
+class _OutputFile:
+  # The output is written to a temporary file beside the target, on close it replaces the target
+  # atomically if the content changed, otherwise the target (and its mtime) is kept.
+  written = 0
+  unchanged = 0
+
+  def __init__(self, file):
+    self.file = file
+    self._tmp_file = _tmp_file(file)
+    self._fh = ptutil.file_openw(self._tmp_file)
+    self.write = self._fh.write
+
+  def close(self):
+    # Return True if the target is written
+    self._fh.close()
+    if ptutil.file_equal(self._tmp_file, self.file):
+      os.remove(self._tmp_file)
+      _OutputFile.unchanged += 1
+      return False
+    if os.path.exists(self.file):
+      os.chmod(self._tmp_file, os.stat(self.file).st_mode & 0o7777)
+    os.replace(self._tmp_file, self.file)
+    _OutputFile.written += 1
+    return True
+
+  def discard(self):
+    self._fh.close()
+    os.remove(self._tmp_file)
+
+class _StreamClosed(Exception):
+  pass
+
+class _StreamOutput:
+  # Pass the output to the consumer of _PTCtx.stream() in chunks of about 'chunk_size' characters,
+  # at most 'max_chunks' chunks are buffered.
+  END = object()
+
+  def __init__(self, chunk_size, max_chunks=4):
+    self._queue = queue.Queue(max_chunks)
+    self._chunks = []
+    self._size = 0
+    self._chunk_size = chunk_size
+    self.closed = False
+
+  def write(self, text):
+    self._chunks.append(text)
+    self._size += len(text)
+    if self._size >= self._chunk_size:
+      self.flush()
+
+  def flush(self):
+    if self._size > 0:
+      self.put(''.join(self._chunks))
+      self._chunks = []
+      self._size = 0
+
+  def getvalue(self):
+    return ''
+
+  def put(self, item):
+    while True:
+      if self.closed:
+        raise _StreamClosed()
+      try:
+        self._queue.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def get(self):
+    return self._queue.get()
+
+class _LazyModule:
+  # The module of the template globals is imported on the first use, not at the start
+  def __init__(self, name):
+    self._name = name
+
+  def __getattr__(self, name):
+    return getattr(__import__(self._name), name)
+
+# The names of this module seen by the templates and extensions, the other modules and helpers of
+# ptctx are not a part of the template globals
+_TEMPLATE_NAMES = ('__name__', '__builtins__', 'collections', 'os', 'ptutil', 'LOG_ERROR', 'LOG_INFO', 'LOG_DEBUG',
+                   'PT', 'pure', 'Tokenizer', '_PTCtx', '_Token', '_Block', '_pt_pipe_call', '_pt_prp', '_pt_raise')
+_template_globals = None
+
+def _new_globals():
+  # The globals of a new context: the names above, inspect and the ptutil functions
+  global _template_globals
+  if _template_globals is None:
+    g = {name: globals()[name] for name in _TEMPLATE_NAMES}
+    g['inspect'] = _LazyModule('inspect')
+    g.update(ptutil.FUNCTIONS)
+    _template_globals = g
+  return _template_globals.copy()
+
 class _PTCtx:
+  _tokenizer_class = None  # Tokenizer, it is set after the class Tokenizer is defined
+
   def __init__(self, template, args={}, output_file=None):
     self._template = template
-    self._output = ''
+    self._output = _OutputBuffer()
     self._output_file_hd = None
-    self._open_output_file(output_file)
     self._code = ''
-    self._g = globals().copy()
+    self._g = _new_globals()
     self._l = locals().copy()
     self._l['ctx'] = self
     if args: self._l.update(args)
@@ -127,10 +833,19 @@ class _PTCtx:
     self.TAB = '  '
     self._depth = 0
     self._exprs = {}
+    self._expr_funcs = {}     # the functions of the expression code objects with the globals of this context
+    self._lines = ()          # the (template line, offset) of every generated code line
+    self._filename = None
+    self._compiled = None
+    self._profiler = None
     self._parent = None
+    self._root = self         # all contexts write the output by the root context
     self._output_indent = True
     self._indent = ''
+    self._base_indent = ''    # the indent of the parent context when it includes this one
+    self._indent_str = ''     # _base_indent + _indent
     self._log_level = 1  # 0-ERROR 1-INFO 2-DEBUG
+    self._open_output_file(output_file)
 
   @property
   def code(self):
@@ -161,15 +876,64 @@ class _PTCtx:
     self._log_level = val
 
   def eval(self):
-    self._translate()
+    code = self._load()
     self._log_code()
     self._g.update(self._l)
     self._g['OrderedDict'] = collections.OrderedDict
-    exec(self._code, self._g)
-    return self._output
+    profiler = self._root._profiler
+    if self._parent is None:
+      # The @pure caches live as long as the render
+      scope, _pure_scope.functions = getattr(_pure_scope, 'functions', None), {}
+      if profiler is not None:
+        profiler.pure_functions = _pure_scope.functions
+    try:
+      if profiler is not None:
+        profiler.run(self, code)
+      else:
+        exec(code, self._g)
+    except BaseException:
+      self._discard_output_file()  # keep the old content of the output file
+      raise
+    finally:
+      if self._parent is None:
+        _pure_scope.functions = scope
+    return self._output.getvalue()
+
+  def stream(self, chunk_size=16384):
+    output = _StreamOutput(chunk_size)
+    self._output = output
+    self._update_writer()
+
+    def render():
+      try:
+        self.eval()
+        output.flush()
+        output.put(_StreamOutput.END)
+      except _StreamClosed:
+        pass
+      except BaseException as ex:
+        try:
+          output.put(ex)
+        except _StreamClosed:
+          pass
+
+    thread = threading.Thread(target=render, daemon=True)
+    thread.start()
+    try:
+      while True:
+        item = output.get()
+        if item is _StreamOutput.END:
+          break
+        if isinstance(item, BaseException):
+          raise item
+        yield item
+      thread.join()
+    finally:
+      # Stop the rendering if the consumer does not read all chunks
+      output.closed = True
 
   def output(self, str):
-    indent = self.indent_str()
+    indent = self._indent_str
     if indent != '':
       if self._output_indent:
         self.output_raw(indent)
@@ -186,67 +950,96 @@ class _PTCtx:
       self.output_raw(str)
 
   def output_exp(self, exp_str):
-    expr = self._exprs[exp_str]
-    ret = self._eval_expr(expr, self._g, self._l)
+    try:
+      func = self._expr_funcs.get(exp_str)
+      if func is None:
+        func = self._expr_funcs[exp_str] = types.FunctionType(self._exprs[exp_str], self._g)
+      ret = func()
+    except Exception as ex:
+      ret = None
+      self._log(LOG_ERROR, 'Failed to eval expression: \'' + exp_str + '\' [' + repr(ex) + ']')
     self.output(str(ret))
 
   def extension(self, py_file, ignore_template=False):
     real_path = self._absolute_file(py_file, ignore_template)
     self._log(LOG_DEBUG, 'Extension file \'' + real_path + '\'')
+    _depend(real_path)  # a directory is changed if a file is added or removed
     if ptutil.file_exists(real_path) and real_path.endswith('.py'):
-      with open(real_path, 'rb') as fh:
-        try:
-          exec(fh.read(), self._g)
-          self._log(LOG_INFO, 'Extension file \'' + real_path + '\' load successfully.')
-        except Exception as ex:
-          self._log(LOG_ERROR, 'Failed to load extension file "' + py_file + '": ' + str(ex))
+      try:
+        self._exec_extension(real_path)
+        self._log(LOG_INFO, 'Extension file \'' + real_path + '\' load successfully.')
+      except Exception as ex:
+        self._log(LOG_ERROR, 'Failed to load extension file "' + py_file + '": ' + str(ex))
     elif ptutil.path_exists(real_path):
       fs = ptutil.path_files(real_path, '*.py')
       for f in fs:
-        with open(f, 'rb') as fh:
-          try:
-            exec(fh.read(), self._g)
-            self._log(LOG_INFO, 'Extension file \'' + f + '\' load successfully.')
-          except Exception as ex:
-            self._log(LOG_ERROR, 'Failed to load extension file "' + f + '": ' + str(ex))
+        try:
+          self._exec_extension(f)
+          self._log(LOG_INFO, 'Extension file \'' + f + '\' load successfully.')
+        except Exception as ex:
+          self._log(LOG_ERROR, 'Failed to load extension file "' + f + '": ' + str(ex))
     else:
       self._log(LOG_ERROR, 'Invalid extension \'' + real_path + '\'')
 
 
+  def _exec_extension(self, file):
+    # The compiled extension files are kept until they are modified
+    _depend(file)
+    st = os.stat(file)
+    stamp = (st.st_mtime_ns, st.st_size)
+    compiled = _compiled_extensions.get(file)
+    if compiled is None or compiled[0] != stamp:
+      with open(file, 'rb') as fh:
+        compiled = (stamp, compile(fh.read(), file, 'exec'))
+      _compiled_extensions[file] = compiled
+    exec(compiled[1], self._g)
+
   def include(self, pt_file, args, offset):
     real_path = self._absolute_file(pt_file)
     ctx = _PTCtx(real_path, args, None)
     ctx._parent = self
+    ctx._root = self._root
+    ctx._base_indent = self._indent_str
     ctx._indent = ' ' * offset
+    ctx._indent_str = ctx._base_indent + ctx._indent
     ctx.eval()
 
   def add_indent(self):
     self._indent += '  '
+    self._indent_str = self._base_indent + self._indent
 
   def remove_indent(self):
     if len(self._indent) >= 2:
       self._indent = self._indent[0:-2]
+      self._indent_str = self._base_indent + self._indent
 
   def indent_str(self):
-    if self._parent is not None:
-      return self._parent.indent_str() + self._indent
-    else:
-      return self._indent
+    return self._indent_str
 
   def output_raw(self, str):
-    if self._parent is not None:
-      self._parent.output_raw(str)
+    self._root._write(str)
+
+  def _update_writer(self):
+    # _write is the output target of the root context, it changes with the output file
+    if self._output_file_hd is not None:
+      self._write = self._output_file_hd.write
     else:
-      if self._output_file_hd is not None:
-        self._output_file_hd.write(str)
-      else:
-        self._output += str
+      self._write = self._output.write
 
   def _close_output_file(self):
     if self._output_file_hd is not None:
-      self._output_file_hd.close()
+      if not self._output_file_hd.close():
+        self._log(LOG_DEBUG, 'Unchanged file: ' + self._output_file_hd.file)
       self._output_file_hd = None
       self._output_file = ''
+      self._update_writer()
+
+  def _discard_output_file(self):
+    if self._output_file_hd is not None:
+      self._output_file_hd.discard()
+      self._output_file_hd = None
+      self._output_file = ''
+      self._update_writer()
 
   def _open_output_file(self, file, ignore_template=False):
     self._close_output_file()
@@ -256,24 +1049,76 @@ class _PTCtx:
     if self._output_file is not None and self._output_file != '':
       real_file = self._absolute_file(self._output_file, ignore_template)
       try:
-        self._output_file_hd = ptutil.file_openw(real_file)
+        self._output_file_hd = _OutputFile(real_file)
         self._log(LOG_INFO, "Generate file: " + real_file)
       except Exception as ex:
         self._log(LOG_ERROR, 'Failed to open file "' + real_file + '": ' + str(ex))
+    self._update_writer()
+
+  def compile(self):
+    # Return the (code, code object, expression table, line table) of the template
+    code = self._load()
+    return self._code, code, self._exprs, self._lines
+
+  def _load(self):
+    if _dependencies is not None:
+      _depend(self._template)
+    if self._compiled is not None:
+      self._code, code, self._exprs, self._lines = self._compiled
+      return code
+
+    real_path = None
+    if os.path.isfile(self._template):
+      real_path = os.path.realpath(self._template)
+      st = os.stat(real_path)
+      stamp = (st.st_mtime_ns, st.st_size)
+      compiled = _compiled_templates.get(real_path)
+      if compiled is not None and compiled[0] == stamp:
+        self._code, code, self._exprs, self._lines = compiled[1]
+        return code
+
+    code = self._load_code()
+    if real_path is not None:
+      _compiled_templates[real_path] = (stamp, (self._code, code, self._exprs, self._lines))
+    return code
+
+  def _load_code(self):
+    self._filename = _template_filename(self._template)
+    key = None
+    if _code_cache.path is not None:
+      key = _code_cache.key(self._template, self._filename)
+      cached = _code_cache.load(key)
+      if cached is not None:
+        self._code, code, self._exprs, self._lines = cached
+        return code
+
+    self._translate()
+    code = self._compile_code()
+    if key is not None:
+      _code_cache.store(key, (self._code, code, self._exprs, self._lines))
+    return code
 
   def _translate(self):
     self._depth = 0
-    tokenizer = Tokenizer(self._template)
+    self._code_output = _OutputBuffer()
+    self._code_lines = []
+    self._code_shifts = []  # template offset - generated offset of every generated line
+    self._code_pos = (1, 0)
+    tokenizer = self._tokenizer_class(self._template)
     code_stack = []
 
     while True:
       line = tokenizer.next_line()
       if line is None:
         break
+      if not line.is_empty:
+        self._code_pos = line.position
       if line.type == 'text':
         self._on_text_(line.text)
       elif line.type == 'expr':
-        self._exprs[line.text] = line  # Cache the expression, it will be used when eval the expression
+        if line.text not in self._exprs:
+          # Compile the expression once, output_exp() only runs the code object
+          self._exprs[line.text] = self._compile_expr(line)
         self._on_expr_(line.text)
       elif line.type == 'code':
         if line.is_blank:
@@ -319,6 +1164,8 @@ class _PTCtx:
         else:
           self._on_code_(code)
     self._on_code_('ctx.close()')
+    self._code = self._code_output.getvalue()
+    self._lines = tuple(self._code_lines)
 
   def _on_text_(self, line):
     self._print_(self.TAB * self._depth + 'ctx.output(' + repr(line) + ')')
@@ -338,106 +1185,126 @@ class _PTCtx:
   def _print_(self, code):
     if not code[-1] in '\r\n':
       code += os.linesep
-    self._code += code
+    self._code_output.write(code)
+    count = code.count('\n')
+    self._code_lines.extend([self._code_pos] * count)
+    self._code_shifts.extend([self._code_pos[1] - len(self.TAB) * self._depth] * count)
+
+  def _compile_code(self):
+    # Compile the generated code with the template file name and lines, so tracebacks,
+    # profilers and trace functions report the template coordinates
+    import ast, linecache
+    lines, shifts = self._lines, self._code_shifts
+    try:
+      tree = ast.parse(self._code, self._filename)
+    except SyntaxError as ex:
+      if ex.lineno is not None and 0 < ex.lineno <= len(lines):
+        line, offset = lines[ex.lineno - 1]
+        ex.offset = max(1, ex.offset + shifts[ex.lineno - 1]) if ex.offset else offset + 1
+        ex.lineno = line
+        ex.end_lineno = ex.end_offset = None
+        ex.text = linecache.getline(self._filename, ex.lineno) or None
+      raise
+    _relocate(tree, [line for line, offset in lines], shifts)
+    return compile(tree, self._filename, 'exec')
+
+  def _compile_expr(self, expr_block):
+    # Compile the expression into the code of a function without arguments, the pipe values are
+    # kept in the local variables of the function (walrus slots)
+    import ast
+    line, offset = expr_block.position if not expr_block.is_empty else (1, 0)
+    try:
+      for walrus in (True, False):
+        self._expr_slots = 0
+        src = self._lower_expr(expr_block.copy(), walrus)
+        tree = ast.parse('lambda: ' + src, self._filename, 'eval')
+        count = src.count('\n') + 1
+        _relocate(tree, [line] * count, [offset - len('lambda: ')] + [offset] * (count - 1))
+        try:
+          code = compile(tree, self._filename, 'eval')
+          break
+        except SyntaxError:
+          # The walrus can not be used in the iterable of a comprehension, the pipes call lambdas instead
+          if not walrus:
+            raise
+    except SyntaxError as ex:
+      # Report the invalid expression when it is evaluated, same as the other evaluation errors
+      code = compile('lambda: _pt_raise(SyntaxError(' + repr(str(ex)) + '))', self._filename, 'eval')
+    return [c for c in code.co_consts if type(c) is types.CodeType][0]
+
+  def _lower_expr(self, expr_block, walrus=True, self_name='__pt_expr_self__'):
+    # Lower the template expression (pipes, ?:, dic.key, self) into a Python expression,
+    # self_name is the variable of 'self' (the value of the pipe)
+    if expr_block.is_empty:
+      return ''
 
-  def _eval_expr(self, expr_block, gg, ll):
-    g = gg
-    l = ll.copy()
-    expr_block = expr_block.copy()
     filters = expr_block.expr_filters()
     if filters is not None:
-      l['__pt_expr_self__'] = self._eval_expr(filters[0], g, l)
+      src = self._lower_expr(filters[0], walrus, self_name)
       for i in range(1, len(filters)):
-        if filters[i].token_count == 1 and callable(eval(filters[i].text, g, l)):
-          filters[i].expr_append_self()
-        l['__pt_expr_self__'] = self._eval_expr(filters[i], g, l, )
-      return l['__pt_expr_self__']
+        slot = '__pt_self_%d__' % self._expr_slots
+        self._expr_slots += 1
+        body = self._lower_expr(filters[i], walrus, slot)
+        if filters[i].token_count == 1:
+          # {{ 'abc' | parse }} is same to {{ 'abc' | parse(self) }} if 'parse' is callable
+          body = '_pt_pipe_call(' + body + ', ' + slot + ')'
+        if walrus:
+          src = '(' + slot + ' := ' + src + ', ' + body + ')[1]'
+        else:
+          src = '(lambda ' + slot + ': ' + body + ')(' + src + ')'
+      return src
 
     ternary = expr_block.expr_ternary()
     if ternary is not None:
-      if self._eval_expr(ternary[0], g, l):
-        return self._eval_expr(ternary[1], g, l)
-      else:
-        return self._eval_expr(ternary[2], g, l)
+      cond, val_true, val_false = [self._lower_expr(b, walrus, self_name) for b in ternary]
+      return '((' + val_true + ') if (' + cond + ') else (' + val_false + '))'
 
-    toks = []
+    chunks = []
     expr_block.expr_reset()
-    next_tok = expr_block.expr_next()
-    while next_tok is not None:
-      if next_tok[0].text in ['(', '[', '{']:
-        sub_block = _Block(next_tok, 'expr')
-        subs = sub_block.expr_subs()
-        txt = ''
-        for sub in subs:
-          if sub.text in ['(', '[', '{', ')', ']', '}', ',', ':']:
-            txt += sub.text
-          else:
-            val_name = self._find_var_name(l)
-            l[val_name] = self._eval_expr(sub, g, l)
-            txt += val_name
-        next_tok = [_Token(txt, 0, 0)]
-      if next_tok[0].text == 'self':
-        next_tok[0].text = '__pt_expr_self__'
-
-      toks += next_tok
-      next_tok = expr_block.expr_next()
+    toks = expr_block.expr_next()
+    while toks is not None:
+      chunks.append(toks)
+      toks = expr_block.expr_next()
 
-    pos, cnt = 0, len(toks)
+    # operands: [src, kind], kind is 'var', 'literal' or None (operators, keywords, blanks)
+    operands = []
+    pos, cnt = 0, len(chunks)
     while pos < cnt:
-      tok = toks[pos]
-      if tok.is_name and pos + 2 < cnt and toks[pos+1].text == '.' and toks[pos+2].is_name:
-        ret_var_name = self._eval_prp(tok.text, toks[pos+2].text, g, l)
-        if ret_var_name is not None:
-          toks[pos+2].text = ret_var_name
-          toks[pos].text = ''
-          toks[pos+1].text = ''
-          pos = pos + 2
+      tok = chunks[pos][0]
+      last_kind = operands[-1][1] if len(operands) > 0 else None
+      if tok.text in ['(', '[', '{']:
+        src = ''
+        for sub in _Block(chunks[pos], 'expr').expr_subs():
+          if sub.text in ['(', '[', '{', ')', ']', '}', ',', ':']:
+            src += sub.text
+          else:
+            src += self._lower_expr(sub, walrus, self_name)
+        if last_kind is not None:
+          operands[-1] = [operands[-1][0] + src, 'var']  # function call or subscript
         else:
-          pos = pos + 2
-          while pos < cnt and pos + 2 < cnt and toks[pos+1].text == '.' and toks[pos+2].is_name:
-            pos = pos + 2
-        continue
-
+          operands.append([src, 'var'])
+      elif (tok.text == '.' and last_kind is not None and pos + 1 < cnt and
+            chunks[pos + 1][0].is_name and not chunks[pos + 1][0].is_keyword):
+        prp = chunks[pos + 1][0].text
+        if last_kind == 'var':
+          operands[-1] = ['_pt_prp(' + operands[-1][0] + ', ' + repr(prp) + ')', 'var']
+        else:
+          operands[-1] = [operands[-1][0] + '.' + prp, last_kind]
+        pos += 1
+      elif tok.text == 'self':
+        operands.append([self_name, 'var'])
+      elif tok.is_name and not tok.is_keyword:
+        operands.append([tok.text, 'var'])
+      elif tok.is_str or tok.is_number:
+        operands.append([tok.text, 'literal'])
+      else:
+        operands.append([tok.text, None])
       pos += 1
-    expr_txt = ''
-    for tok in toks:
-      expr_txt += tok.text
-    try:
-      return eval(expr_txt, g, l)
-    except Exception as ex:
-      self._log(LOG_ERROR, 'Failed to eval expression: \'' + expr_txt + '\' [' + repr(ex) + ']')
-
-  def _eval_prp(self, name, prp, g, l):
-    #if prp in l or prp in g:   # support the property name is a variable but not a string.
-    #  prp = eval(prp, g, l)
-    try:
-      val = eval(name, g, l)
-    except NameError:
-      return None
-
-    val1 = None
-    if hasattr(val, prp):
-      val1 = eval('val.' + prp)
-      if callable(val1):
-        val1 = None
-    if val1 is None:
-      try:
-        val1 = eval('val[' + repr(prp) + ']')
-      except Exception as ex:
-        return None
-    result_name = self._find_var_name(l)
-    l[result_name] = val1
-    return result_name
 
-  def _find_var_name(self, l):
-    i = 0
-    while True:
-      name = f'___mid_var_{i}___'
-      if name in l:
-        i += 1
-      else:
-        break
-    return name
+    src = ''
+    for operand in operands:
+      src += operand[0]
+    return src
 
   def _log(self, level, msg):
     if level > self._log_level: return
@@ -458,6 +1325,18 @@ class _PTCtx:
     return os.linesep.join(lines)
 
 class Tokenizer:
+  # The next_tok() options (process_string, process_c_comments, process_python_comments, custom_toks)
+  _TEXT_OPTIONS = (False, False, False, ('{{', '{%'))
+  _CODE_OPTIONS = (True, False, True, ('%}',))
+  _EXPR_OPTIONS = (True, False, True, ('}}',))
+
+  # Compiled scanners by the next_tok() options
+  _scanners = {}
+  _string_patterns = {
+    "'": re.compile(r"'[^'\\]*(?:\\.[^'\\]*)*'", re.DOTALL),
+    '"': re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL),
+  }
+
   def __init__(self, data):
     self._text = data
     self._path = os.path.curdir
@@ -472,6 +1351,7 @@ class Tokenizer:
     self._end = len(self._text)
 
     self._lines = None
+    self._line_idx = 0
     self._state = 'text'
     self._code_offset = 0
 
@@ -492,127 +1372,91 @@ class Tokenizer:
                process_c_comments=False,
                process_python_comments=True,
                custom_toks=[]):  # custom_toks must be single line token
-    if __debug__:
-      for ctok in custom_toks:
-        if '\r' in ctok or '\n' in ctok:
-          raise AssertionError('CR,LF can not appear in the custom tokens parameter.')
-
-    line,offset = self._line, self._offset
-    pos = self._pos
-    if pos >= self._end:
-      return None
-
-    ch = self._text[pos]
-
-    for cus_tok in custom_toks:
-      cus_len = len(cus_tok)
-      if ch == cus_tok[0] and pos + cus_len <= self._end and cus_tok == self._text[pos:pos + cus_len]:
-        self._pos += cus_len
-        self._offset += cus_len
-        return _Token(cus_tok, line, offset)
-
-    if ch == '\n':
-      pass
-    elif ch == '\r':
-      if pos + 1 < self._end and self._text[pos + 1] == '\n':
-        pos = pos + 1
-    elif ch in ['\t', ' ']:
-      while pos + 1 < self._end and self._text[pos + 1] in ['\t', ' ']:
-        pos = pos + 1
-    elif '0' <= ch <= '9':
-      while pos + 1 < self._end and '0' <= self._text[pos + 1] <= '9':
-        pos = pos + 1
-    elif ch == '_' or ('a' <= ch <= 'z') or ('A' <= ch <= 'Z'):
-      while pos + 1 < self._end and (('0' <= self._text[pos + 1] <= '9') or
-                                     ('a' <= self._text[pos + 1] <= 'z') or
-                                     ('A' <= self._text[pos + 1] <= 'Z') or
-                                     self._text[pos + 1] == '_'):
-        pos = pos + 1
-
-    elif ch == '/' and pos + 1 < self._end and self._text[pos + 1] == '/' and process_c_comments:
-      return self._fetch_line_comments()
-    elif ch == '/' and pos + 1 < self._end and self._text[pos + 1] == '*' and process_c_comments:
-      return self._fetch_block_comments()
-    elif ch == '#' and process_python_comments:
-      return self._fetch_line_comments('#')
-    elif ch in ['"', '\''] and pos + 2 < self._end and self._text[pos:pos + 3] in ['"""',"'''"] and process_python_comments:
-      return self._fetch_block_comments(self._text[pos:pos + 3], self._text[pos:pos + 3])
-    elif ch in ['"', '\''] and process_string:
-      return self._fetch_string()
-    else:
-      pass
-
-    tok = self._text[self._pos:pos + 1]
-    self._pos = pos + 1
-    if tok[-1] in '\r\n':
-      self._offset = 0
-      self._line = self._line + 1
-    else:
-      self._offset = self._offset + len(tok)
-    return _Token(tok, line, offset)
+    for tok in self._tokens((process_string, process_c_comments, process_python_comments, tuple(custom_toks))):
+      return tok
+    return None
+
+  def _tokens(self, options):
+    # Yield the tokens from the current position, options is the tuple of next_tok() parameters
+    scanner = self._scanner(options)
+    text, end = self._text, self._end
+    while self._pos < end:
+      m = scanner.match(text, self._pos)
+      kind = m.lastgroup
+      if kind == 'string':
+        yield self._fetch_string()
+      elif kind == 'block_comments':
+        comments_start = m.group()
+        yield self._fetch_block_comments(comments_start, '*/' if comments_start == '/*' else comments_start)
+      else:
+        tok, line, offset = sys.intern(m.group()), self._line, self._offset
+        self._pos = m.end()
+        if kind == 'newline':
+          self._line, self._offset = line + 1, 0
+        else:
+          self._offset = offset + len(tok)
+        yield _Token(tok, line, offset)
+
+  def _scanner(self, options):
+    scanner = Tokenizer._scanners.get(options)
+    if scanner is not None:
+      return scanner
+
+    process_string, process_c_comments, process_python_comments, custom_toks = options
+    for ctok in custom_toks:
+      if '\r' in ctok or '\n' in ctok:
+        raise AssertionError('CR,LF can not appear in the custom tokens parameter.')
+    # The alternatives are tried in order, it must be same to the order of CharTokenizer.next_tok()
+    patterns = []
+    if len(custom_toks) > 0:
+      patterns.append('(?P<custom>' + '|'.join(re.escape(ctok) for ctok in custom_toks) + ')')
+    patterns.append(r'(?P<newline>\r\n|\r|\n)')
+    patterns.append(r'(?P<word>[ \t]+|[0-9]+|[_a-zA-Z][_a-zA-Z0-9]*)')
+    line_comments, block_comments = [], []
+    if process_c_comments:
+      line_comments.append('//')
+      block_comments.append(r'/\*')
+    if process_python_comments:
+      line_comments.append('#')
+      block_comments.append('"""')
+      block_comments.append("'''")
+    if len(line_comments) > 0:
+      # A comment line ends before LF or a single CR, the CR of CRLF belongs to the comments
+      patterns.append('(?P<line_comments>(?:' + '|'.join(line_comments) + r')(?:[^\r\n]|\r(?=\n))*)')
+    if len(block_comments) > 0:
+      patterns.append('(?P<block_comments>' + '|'.join(block_comments) + ')')
+    if process_string:
+      patterns.append('(?P<string>[\'"])')
+    patterns.append('(?P<char>.)')
+    scanner = re.compile('|'.join(patterns), re.DOTALL)
+    Tokenizer._scanners[options] = scanner
+    return scanner
 
   def _fetch_string(self):
     ch, line, offset = self._text[self._pos], self._line, self._offset
-    pos = self._pos + 1
-    while pos < self._end:
-      next_ch = self._text[pos]
-      if next_ch == ch:
-        break
-      elif next_ch == '\\':
-        pos = pos + 1
-      pos = pos + 1
-    if pos >= self._end:
+    m = Tokenizer._string_patterns[ch].match(self._text, self._pos)
+    if m is None:
       raise SyntaxError('Invalid string at position line %d, offset %d.' % (self._line, self._offset))
-    pos = pos + 1
-    tok = self._text[self._pos:pos]
-    self._pos = pos
+    tok = m.group()
+    self._pos = m.end()
     self._offset = self._offset + len(tok)
-    return _Token(tok,line,offset)
+    return _Token(tok, line, offset)
 
   def _fetch_block_comments(self, comments_start='/*', comments_end='*/'):
-    clen = len(comments_end)
     line, offset = self._line, self._offset
-    pos = self._pos + len(comments_start)
-    self._offset += len(comments_start)
-    find_end = False
-    while pos < self._end:
-      ch = self._text[pos]
-      if ch == '\n':
-        self._offset = 0
-        self._line += 1
-        pos += 1
-      elif ch == '\r' and (pos + 1 >= self._end or self._text[pos + 1] != '\n'):
-        self._offset = 0
-        self._line += 1
-        pos += 1
-      elif ch == comments_end[0] and pos + clen - 1 < self._end and self._text[pos:pos + clen] == comments_end:
-        pos += clen
-        self._offset += clen
-        find_end = True
-        break
-      else:
-        self._offset += 1
-        pos += 1
-
-    if not find_end:
+    end = self._text.find(comments_end, self._pos + len(comments_start))
+    if end < 0:
       raise SyntaxError("Invalid block comments at line %d, offset %d" % (line, offset))
-    tok = self._text[self._pos:pos]
-    self._pos = pos
-    return _Token(tok, line, offset)
-
-  def _fetch_line_comments(self, comments_symbol='//'):
-    line, offset = self._line, self._offset
-    pos = self._pos + len(comments_symbol)
-    while pos < self._end:
-      if self._text[pos] == '\n':
-        break
-      elif self._text[pos] == '\r' and (pos + 1 >= self._end or self._text[pos + 1] != '\n'):
-        break
-      else:
-        pos = pos + 1
-    tok = self._text[self._pos:pos]
-    self._pos = pos
-    self._offset = self._offset + len(tok)
+    end += len(comments_end)
+    tok = self._text[self._pos:end]
+    self._pos = end
+    # CRLF, LF and single CR are line breaks
+    newlines = tok.count('\n') + tok.count('\r') - tok.count('\r\n')
+    if newlines > 0:
+      self._line += newlines
+      self._offset = len(tok) - max(tok.rfind('\n'), tok.rfind('\r')) - 1
+    else:
+      self._offset += len(tok)
     return _Token(tok, line, offset)
 
   def _init_lines(self):
@@ -710,11 +1554,11 @@ class Tokenizer:
   def next_line(self):
     if self._lines is None:
       self._init_lines()
-    while len(self._lines) > 0:
-      if self._lines[0] is None:
-        self._lines.pop(0)
-        continue
-      return self._lines.pop(0)
+    while self._line_idx < len(self._lines):
+      line = self._lines[self._line_idx]
+      self._line_idx += 1
+      if line is not None:
+        return line
 
 
   def _parse_text_lines(self):
@@ -723,22 +1567,27 @@ class Tokenizer:
 
     text_lines = []
     toks = []
-    while True:
-      tok = self.next_tok(process_string=False, process_c_comments=False, process_python_comments=False, custom_toks=['{{', '{%'])
-      if tok is None:
-        break
-      elif tok.text == '{{':
-        self._state = 'expr'
-        break
-      elif tok.text == '{%':
-        self._state = 'code'
-        self._code_offset = tok.offset
+    line, offset, pos = self._line, self._offset, self._end
+    # The text scanner matches every character, so the matches are continuous
+    for m in self._scanner(Tokenizer._TEXT_OPTIONS).finditer(self._text, self._pos):
+      # Most tokens are repeated words, share them instead of keeping a str object per token
+      tok, kind = sys.intern(m.group()), m.lastgroup
+      if kind == 'custom':
+        self._state = 'expr' if tok == '{{' else 'code'
+        if tok == '{%':
+          self._code_offset = offset
+        pos = m.end()
+        offset += len(tok)
         break
 
-      toks.append(tok)
-      if tok.is_newline:
+      toks.append(_Token(tok, line, offset))
+      if kind == 'newline':
+        line, offset = line + 1, 0
         text_lines.append(_Block(toks, 'text'))
         toks = []
+      else:
+        offset += len(tok)
+    self._line, self._offset, self._pos = line, offset, pos
 
     if len(toks) > 0:
       text_lines.append(_Block(toks, 'text'))
@@ -752,12 +1601,8 @@ class Tokenizer:
     rm_tail_blank = ''
 
     # 1. Parse code into lines
-    while True:
-      pre_tok = tok
-      tok = self.next_tok(custom_toks=['%}'])
-      if tok is None:
-        raise SyntaxError("The code block is not completed at line %d." % self._line)
-
+    for next_tok in self._tokens(Tokenizer._CODE_OPTIONS):
+      pre_tok, tok = tok, next_tok
       if tok.text == '%}':
         if pre_tok is not None and pre_tok.text in ['-', '+']:
           rm_tail_blank = pre_tok.text
@@ -780,7 +1625,8 @@ class Tokenizer:
       if tok.is_newline:
         lines.append(_Block(line, 'code'))
         line = []
-    # end while
+    else:
+      raise SyntaxError("The code block is not completed at line %d." % self._line)
 
     if len(line) > 0:
       lines.append(_Block(line, 'code'))
@@ -819,10 +1665,7 @@ class Tokenizer:
 
   def _parse_expr(self):
     toks = []
-    while True:
-      tok = self.next_tok(custom_toks=['}}'])
-      if tok is None:
-        raise SyntaxError("The expression is not completed at line %d." % self._line)
+    for tok in self._tokens(Tokenizer._EXPR_OPTIONS):
       txt = tok.text
       if txt.startswith('#'):
         raise SyntaxError("The comments '%s' can not appear in the expression '%s'." % (tok, self._line))
@@ -835,6 +1678,8 @@ class Tokenizer:
         break
       else:
         toks.append(tok)
+    else:
+      raise SyntaxError("The expression is not completed at line %d." % self._line)
     # Check blank-removing identifier
     rm_head_blank = '+'
     rm_tail_blank = '+'
@@ -861,75 +1706,230 @@ class Tokenizer:
     expr.remove_tail_blank = rm_tail_blank
     return expr
 
+class CharTokenizer(Tokenizer):
+  # The original character by character scanner, it is kept for differential testing of Tokenizer.
+  def _tokens(self, options):
+    process_string, process_c_comments, process_python_comments, custom_toks = options
+    while True:
+      tok = self.next_tok(process_string, process_c_comments, process_python_comments, list(custom_toks))
+      if tok is None:
+        return
+      yield tok
+
+  def _parse_text_lines(self):
+    if self._pos >= self._end:
+      return None
+
+    text_lines = []
+    toks = []
+    while True:
+      tok = self.next_tok(process_string=False, process_c_comments=False, process_python_comments=False, custom_toks=['{{', '{%'])
+      if tok is None:
+        break
+      elif tok.text == '{{':
+        self._state = 'expr'
+        break
+      elif tok.text == '{%':
+        self._state = 'code'
+        self._code_offset = tok.offset
+        break
+
+      toks.append(tok)
+      if tok.is_newline:
+        text_lines.append(_Block(toks, 'text'))
+        toks = []
+
+    if len(toks) > 0:
+      text_lines.append(_Block(toks, 'text'))
+    return text_lines
+
+  def next_tok(self,
+               process_string=True,
+               process_c_comments=False,
+               process_python_comments=True,
+               custom_toks=[]):  # custom_toks must be single line token
+    if __debug__:
+      for ctok in custom_toks:
+        if '\r' in ctok or '\n' in ctok:
+          raise AssertionError('CR,LF can not appear in the custom tokens parameter.')
+
+    line,offset = self._line, self._offset
+    pos = self._pos
+    if pos >= self._end:
+      return None
+
+    ch = self._text[pos]
+
+    for cus_tok in custom_toks:
+      cus_len = len(cus_tok)
+      if ch == cus_tok[0] and pos + cus_len <= self._end and cus_tok == self._text[pos:pos + cus_len]:
+        self._pos += cus_len
+        self._offset += cus_len
+        return _Token(cus_tok, line, offset)
+
+    if ch == '\n':
+      pass
+    elif ch == '\r':
+      if pos + 1 < self._end and self._text[pos + 1] == '\n':
+        pos = pos + 1
+    elif ch in ['\t', ' ']:
+      while pos + 1 < self._end and self._text[pos + 1] in ['\t', ' ']:
+        pos = pos + 1
+    elif '0' <= ch <= '9':
+      while pos + 1 < self._end and '0' <= self._text[pos + 1] <= '9':
+        pos = pos + 1
+    elif ch == '_' or ('a' <= ch <= 'z') or ('A' <= ch <= 'Z'):
+      while pos + 1 < self._end and (('0' <= self._text[pos + 1] <= '9') or
+                                     ('a' <= self._text[pos + 1] <= 'z') or
+                                     ('A' <= self._text[pos + 1] <= 'Z') or
+                                     self._text[pos + 1] == '_'):
+        pos = pos + 1
+
+    elif ch == '/' and pos + 1 < self._end and self._text[pos + 1] == '/' and process_c_comments:
+      return self._fetch_line_comments()
+    elif ch == '/' and pos + 1 < self._end and self._text[pos + 1] == '*' and process_c_comments:
+      return self._fetch_block_comments()
+    elif ch == '#' and process_python_comments:
+      return self._fetch_line_comments('#')
+    elif ch in ['"', '\''] and pos + 2 < self._end and self._text[pos:pos + 3] in ['"""',"'''"] and process_python_comments:
+      return self._fetch_block_comments(self._text[pos:pos + 3], self._text[pos:pos + 3])
+    elif ch in ['"', '\''] and process_string:
+      return self._fetch_string()
+    else:
+      pass
+
+    tok = self._text[self._pos:pos + 1]
+    self._pos = pos + 1
+    if tok[-1] in '\r\n':
+      self._offset = 0
+      self._line = self._line + 1
+    else:
+      self._offset = self._offset + len(tok)
+    return _Token(tok, line, offset)
+
+  def _fetch_string(self):
+    ch, line, offset = self._text[self._pos], self._line, self._offset
+    pos = self._pos + 1
+    while pos < self._end:
+      next_ch = self._text[pos]
+      if next_ch == ch:
+        break
+      elif next_ch == '\\':
+        pos = pos + 1
+      pos = pos + 1
+    if pos >= self._end:
+      raise SyntaxError('Invalid string at position line %d, offset %d.' % (self._line, self._offset))
+    pos = pos + 1
+    tok = self._text[self._pos:pos]
+    self._pos = pos
+    self._offset = self._offset + len(tok)
+    return _Token(tok,line,offset)
+
+  def _fetch_block_comments(self, comments_start='/*', comments_end='*/'):
+    clen = len(comments_end)
+    line, offset = self._line, self._offset
+    pos = self._pos + len(comments_start)
+    self._offset += len(comments_start)
+    find_end = False
+    while pos < self._end:
+      ch = self._text[pos]
+      if ch == '\n':
+        self._offset = 0
+        self._line += 1
+        pos += 1
+      elif ch == '\r' and (pos + 1 >= self._end or self._text[pos + 1] != '\n'):
+        self._offset = 0
+        self._line += 1
+        pos += 1
+      elif ch == comments_end[0] and pos + clen - 1 < self._end and self._text[pos:pos + clen] == comments_end:
+        pos += clen
+        self._offset += clen
+        find_end = True
+        break
+      else:
+        self._offset += 1
+        pos += 1
+
+    if not find_end:
+      raise SyntaxError("Invalid block comments at line %d, offset %d" % (line, offset))
+    tok = self._text[self._pos:pos]
+    self._pos = pos
+    return _Token(tok, line, offset)
+
+  def _fetch_line_comments(self, comments_symbol='//'):
+    line, offset = self._line, self._offset
+    pos = self._pos + len(comments_symbol)
+    while pos < self._end:
+      if self._text[pos] == '\n':
+        break
+      elif self._text[pos] == '\r' and (pos + 1 >= self._end or self._text[pos + 1] != '\n'):
+        break
+      else:
+        pos = pos + 1
+    tok = self._text[self._pos:pos]
+    self._pos = pos
+    self._offset = self._offset + len(tok)
+    return _Token(tok, line, offset)
+
+_PTCtx._tokenizer_class = Tokenizer
+
+_KEYWORDS = frozenset(['and', 'as', 'assert', 'break', 'class', 'continue', 'def', 'del', 'elif', 'else', 'except',
+                       'False', 'finally', 'for', 'from', 'global', 'if', 'import', 'in', 'is', 'lambda', 'None',
+                       'nonlocal', 'not', 'or', 'pass', 'raise', 'return', 'True', 'try', 'while', 'with', 'yield'])
+
 class _Token:
+  __slots__ = ('text', 'line', 'offset')
+
   def __init__(self, text, line=-1, offset=-1):
-    self._text = text
-    self._line = line
-    self._offset = offset
+    self.text = text
+    self.line = line
+    self.offset = offset
 
   def copy(self):
-    t = _Token(self.text, self._line, self._offset)
-    return t
+    return _Token(self.text, self.line, self.offset)
 
   def __str__(self):
-    return self._text
-
-  @property
-  def text(self):
-    return self._text
-
-  @text.setter
-  def text(self, val):
-    self._text = val
+    return self.text
 
   @property
   def length(self):
-    return len(self._text)
-
-  @property
-  def line(self):
-    return self._line
-
-  @property
-  def offset(self):
-    return self._offset
+    return len(self.text)
 
   @property
   def is_number(self):
-    ch = self._text[0]
+    ch = self.text[0]
     return '0' <= ch <= '9'
 
   @property
   def is_name(self):
-    ch = self._text[0]
+    ch = self.text[0]
     return ch == '_' or ('a' <= ch <= 'z') or ('A' <= ch <= 'Z')
 
   @property
   def is_str(self):
-    ch = self._text[0]
+    ch = self.text[0]
     return ch == '\'' or ch == '"'
 
   @property
   def is_newline(self):
-    ch = self._text[0]
-    return ch == '\r' or ch == '\n'
+    return self.text[0] in '\r\n'
 
   @property
   def is_blank(self):
-    ch = self._text[0]
-    return ch == ' ' or ch == '\t'
+    return self.text[0] in ' \t'
 
   @property
   def is_blank_or_newline(self):
-    return self.is_blank or self.is_newline
+    return self.text[0] in ' \t\r\n'
 
   @property
   def is_keyword(self):
-    return self._text in ['and', 'as', 'assert', 'break', 'class', 'continue', 'def', 'del', 'elif', 'else', 'except',
-                          'False', 'finally', 'for', 'from', 'global', 'if', 'import', 'in', 'is', 'lambda', 'None',
-                          'nonlocal', 'not', 'or', 'pass', 'raise', 'return', 'True', 'try', 'while', 'with', 'yield']
+    return self.text in _KEYWORDS
 
 class _Block:
+  __slots__ = ('_tokens', '_type', '_single_line_code', '_code_offset', '_expr_pos',
+               '_remove_head_blank', '_remove_tail_blank', '_text', '_first_word', '_is_blank')
+
   def __init__(self, tokens, block_type):
     assert type(tokens) is list, 'tokens must be _Token list'
     assert block_type in ['text', 'code', 'expr'], 'type must be one value of [\'text\', \'code\', \'expr\']'
@@ -946,6 +1946,13 @@ class _Block:
     self._expr_pos = 0
     self._remove_head_blank = ''
     self._remove_tail_blank = ''
+    self._reset_cache()
+
+  def _reset_cache(self):
+    # The cached properties, they must be reset after the tokens are changed
+    self._text = None
+    self._first_word = None
+    self._is_blank = None
 
   def __str__(self):
     return '[' + self.type + ']' + '"' + self.text + '"'
@@ -975,28 +1982,26 @@ class _Block:
   def is_empty(self):
     return len(self._tokens) == 0
 
+  @property
+  def position(self):
+    # (line, offset) of the first token, the line starts from 1
+    return self._tokens[0].line + 1, self._tokens[0].offset
+
   @property
   def text(self):
-    txt = ''
-    for tok in self._tokens:
-      txt += tok.text
-    return txt
+    if self._text is None:
+      self._text = ''.join([tok.text for tok in self._tokens])
+    return self._text
 
   @property
   def length(self):
-    l = 0
-    for tok in self._tokens:
-      l += tok.length
-    return l
+    return sum([tok.length for tok in self._tokens])
 
   @property
   def is_blank(self):
-    for tok in self._tokens:
-      if tok.is_blank_or_newline:
-        continue
-      else:
-        return False
-    return True
+    if self._is_blank is None:
+      self._is_blank = all(tok.is_blank_or_newline for tok in self._tokens)
+    return self._is_blank
 
   @property
   def is_end_of_line(self):
@@ -1013,6 +2018,11 @@ class _Block:
 
   @property
   def first_word(self):
+    if self._first_word is None:
+      self._first_word = self._find_first_word()
+    return self._first_word
+
+  def _find_first_word(self):
     tok_count = len(self._tokens)
     for i in range(0, tok_count):
       if self._tokens[i].is_blank_or_newline:
@@ -1083,6 +2093,7 @@ class _Block:
     elif blen < length:
       length = blen
 
+    self._reset_cache()
     if blen == length:
       self._tokens.pop(0)
     elif blen > length:
@@ -1090,12 +2101,14 @@ class _Block:
       self._tokens[0] = _Token(' ' * (blen - length), tok.line, tok.offset + length)
 
   def trim_begin(self):
+    self._reset_cache()
     while len(self._tokens) > 0:
       if self._tokens[0].is_blank_or_newline:
         del self._tokens[0]
       else:
         break
   def trim_end(self):
+    self._reset_cache()
     while len(self._tokens) > 0:
       if self._tokens[-1].is_blank_or_newline:
         del self._tokens[-1]
@@ -1166,6 +2179,7 @@ class _Block:
     last  = _Block(self._tokens[-1:], 'expr')
     self._tokens.pop(0)
     self._tokens.pop(-1)
+    self._reset_cache()
     ret = []
     while True:
       sub = self.expr_next([':', ','])
@@ -1178,13 +2192,3 @@ class _Block:
     ret.insert(0, first)
     ret.append(last)
     return ret
-
-  def expr_append_self(self):
-    line = -1
-    offset = -1
-    if len(self._tokens) > 0:
-      line = self._tokens[-1].line
-      offset = self._tokens[-1].offset + self._tokens[-1].length
-    self._tokens.append(_Token('(',    line, offset))
-    self._tokens.append(_Token('self', line, offset + 1))
-    self._tokens.append(_Token(')',    line, offset + 5))
\ No newline at end of file
@@ -0,0 +1,110 @@
+import os
+import socket
+import struct
+import marshal
+
+# The render daemon keeps the compiled templates and extensions of ptctx warm between the requests,
+# the templates and extensions are compiled again when the files are modified.
+# A message is a 4-byte big-endian length and the marshalled dictionary (no import cost for the client):
+#   request:  {"cwd": <client directory>, "argv": [<template>, <options>...]} or {"command": "stop"}
+#   response: {"output": <text printed by PT.execute>} or {"error": <message>}
+
+def default_socket():
+  import tempfile
+  return os.environ.get('PT_SOCKET') or os.path.join(tempfile.gettempdir(), 'pt-%d.sock' % os.getuid())
+
+def serve(path=None, ready=None):
+  path = path or default_socket()
+  if os.path.exists(path):
+    # Only a stale socket is removed, not the socket of a running server
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+      try:
+        conn.connect(path)
+      except (ConnectionRefusedError, FileNotFoundError):
+        pass
+      else:
+        raise FileExistsError('A PT server is already running on ' + path)
+    if os.path.exists(path):
+      os.unlink(path)
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    server.bind(path)
+    os.chmod(path, 0o600)  # the requests run any Python code, only the owner can connect
+    server.listen(16)
+    print('PT server is listening on ' + path)
+    if ready is not None:
+      ready()
+    while True:
+      conn, _ = server.accept()
+      with conn:
+        try:
+          request = _recv(conn)
+          if request.get('command') == 'stop':
+            _send(conn, {'output': ''})
+            break
+          _send(conn, {'output': _execute(request['cwd'], request['argv'])})
+        except KeyboardInterrupt:
+          raise
+        except BaseException as ex:
+          # exit() of a template or an extension fails the request, not the server
+          try:
+            _send(conn, {'error': str(ex) if isinstance(ex, Exception) else '%s: %s' % (type(ex).__name__, ex)})
+          except OSError:
+            pass
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.close()
+    if os.path.exists(path):
+      os.unlink(path)
+
+def execute(path, argv):
+  # Send the command line to the server and return the output
+  return _request(path, {'cwd': os.getcwd(), 'argv': list(argv)})
+
+def stop(path=None):
+  _request(path or default_socket(), {'command': 'stop'})
+
+def _execute(cwd, argv):
+  import io
+  import contextlib
+  import ptctx
+
+  if '-watch' in argv:
+    raise ValueError('The option "-watch" can not be used with the render server.')
+  old_cwd = os.getcwd()
+  output = io.StringIO()
+  try:
+    os.chdir(cwd)
+    with contextlib.redirect_stdout(output):
+      ptctx.PT.execute(['pt'] + argv)
+  finally:
+    os.chdir(old_cwd)
+  return output.getvalue()
+
+def _request(path, request):
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+    conn.connect(path)
+    _send(conn, request)
+    response = _recv(conn)
+  if 'error' in response:
+    raise RuntimeError('PT server error: ' + response['error'])
+  return response['output']
+
+def _send(conn, message):
+  data = marshal.dumps(message)
+  conn.sendall(struct.pack('>I', len(data)) + data)
+
+def _recv(conn):
+  size = struct.unpack('>I', _recv_exact(conn, 4))[0]
+  return marshal.loads(_recv_exact(conn, size))
+
+def _recv_exact(conn, size):
+  chunks = []
+  while size > 0:
+    chunk = conn.recv(min(size, 1 << 20))
+    if not chunk:
+      raise ConnectionError('The connection is closed.')
+    chunks.append(chunk)
+    size -= len(chunk)
+  return b''.join(chunks)
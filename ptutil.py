@@ -1,10 +1,8 @@
 import os
-import json
-import configparser
-import shutil
-import xml.dom.minidom
-import sqlite3
+import types
 from collections import OrderedDict
+# json, configparser, shutil, sqlite3 and xml are imported by the functions which use them,
+# so the templates which do not load data start fast.
 
 
 def file_path(file):
@@ -41,7 +39,22 @@ def file_write_all(file, data, encoding='utf-8'):
   with open(file, 'w', newline='\n', encoding=encoding) as fh:
     fh.write(data)
 
+def file_equal(file1, file2):
+  try:
+    if os.path.getsize(file1) != os.path.getsize(file2):
+      return False
+    with open(file1, 'rb') as fh1, open(file2, 'rb') as fh2:
+      while True:
+        data1, data2 = fh1.read(65536), fh2.read(65536)
+        if data1 != data2:
+          return False
+        if not data1:
+          return True
+  except OSError:
+    return False
+
 def file_copy(src_file, dest_file):
+  import shutil
   shutil.copy(src_file, dest_file)
 
 def path_create(path):
@@ -53,6 +66,7 @@ def path_exists(path):
 
 
 def path_delete(path):
+  import shutil
   shutil.rmtree(path, ignore_errors=True)
 
 def path_files(path, pattern):
@@ -67,6 +81,7 @@ def path_files(path, pattern):
   return ret
 
 def pth_copy(src_dir, dest_dir):
+  import shutil
   shutil.copytree(src_dir, dest_dir)
 
 
@@ -77,6 +92,7 @@ def data_read(txt):
     return txt
 
 def data_json(json_input):
+  import json
   text = json_input
   if file_exists(json_input):
     text = data_read(json_input)
@@ -85,6 +101,7 @@ def data_json(json_input):
   return json.loads(text, object_pairs_hook=OrderedDict)
 
 def data_ini(ini_input):
+  import configparser
   ret = OrderedDict([])
   no_section = False
   config = configparser.ConfigParser(inline_comment_prefixes=';')
@@ -120,35 +137,305 @@ def data_KV(KV_input):
       ret[key.strip()] = value.strip().strip('"')
   return ret
 
-def _data_sqlite_row_factory(cursor, row):
-    return OrderedDict((col[0], row[idx]) for idx, col in enumerate(cursor.description))
-
-def data_sqlite(sql_file, sql_query):
-  with sqlite3.connect(sql_file) as conn:
-    conn.row_factory = _data_sqlite_row_factory
-    c = conn.cursor()
-    c.execute(sql_query)
-    rows = c.fetchall()
-    if len(rows) == 0:
-      return None
-    elif len(rows) == 1:
-      return rows[0]
+class SqliteRow(tuple):
+  # A row of a SQLite query, the values are the items of the tuple. The rows of a query share a
+  # subclass which has the column index and a property for every column, so row.col, row['col'],
+  # row[index] and row.items() work without a dict per row.
+  __slots__ = ()
+  _columns = ()
+  _index = {}
+
+  def __getitem__(self, key):
+    if type(key) is str:
+      return tuple.__getitem__(self, self._index[key])
+    return tuple.__getitem__(self, key)
+
+  def __iter__(self):
+    return iter(self._columns)
+
+  def __contains__(self, key):
+    return key in self._index
+
+  def get(self, key, default=None):
+    index = self._index.get(key)
+    return default if index is None else tuple.__getitem__(self, index)
+
+  def keys(self):
+    return list(self._columns)
+
+  def values(self):
+    return list(tuple.__iter__(self))
+
+  def items(self):
+    return list(zip(self._columns, tuple.__iter__(self)))
+
+  def __repr__(self):
+    return 'SqliteRow(' + ', '.join('%s=%r' % item for item in self.items()) + ')'
+
+  def __reduce__(self):
+    # The row subclasses are generated, pickle the row by the columns and the values
+    return _sqlite_row, (self._columns, tuple(tuple.__iter__(self)))
+
+# The column names -> the SqliteRow subclass of the rows
+_sqlite_row_types = {}
+
+def _sqlite_row_type(cursor):
+  return _sqlite_columns_type(tuple(col[0] for col in cursor.description))
+
+def _sqlite_row(columns, values):
+  return _sqlite_columns_type(columns)(values)
+
+def _sqlite_columns_type(columns):
+  row_type = _sqlite_row_types.get(columns)
+  if row_type is None:
+    import collections
+    attrs = {'__slots__': (), '_columns': columns, '_index': {name: i for i, name in enumerate(columns)}}
+    # The item getters of the columns are the fields of a namedtuple of the same length, so the
+    # access is as fast as a namedtuple field on every Python (the invalid names are renamed)
+    fields = collections.namedtuple('SqliteFields', [str(name) for name in columns], rename=True)
+    for name, i in attrs['_index'].items():
+      if name.isidentifier() and not hasattr(SqliteRow, name):
+        attrs[name] = vars(fields)[fields._fields[i]]
+    row_type = _sqlite_row_types[columns] = type('SqliteRow', (SqliteRow,), attrs)
+  return row_type
+
+# The open SQLite connections: (pid, thread, path, mode) -> connection, closed by sqlite_close()
+_sqlite_connections = {}
+
+def sqlite_connect(sql_file, mode='rw', mmap_size=256 * 1024 * 1024):
+  # The pooled connection of the database file. mode: 'rw', 'ro' (read-only) or 'immutable' (read-only,
+  # the file must not change while the connection is open), the read-only modes use mmap_size.
+  import threading
+  real_path = os.path.realpath(sql_file)
+  key = (os.getpid(), threading.get_ident(), real_path, mode)
+  conn = _sqlite_connections.get(key)
+  if conn is None:
+    import sqlite3
+    if mode == 'rw':
+      conn = sqlite3.connect(sql_file, check_same_thread=False)
+    elif mode == 'ro' or mode == 'immutable':
+      if not file_exists(sql_file):
+        raise FileNotFoundError('File not found: ' + sql_file)
+      from urllib.parse import quote
+      uri = 'file:' + quote(real_path) + '?mode=ro' + ('&immutable=1' if mode == 'immutable' else '')
+      conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+      conn.execute('PRAGMA mmap_size=%d' % mmap_size)
     else:
-      return rows
+      raise ValueError('Invalid SQLite open mode "%s".' % mode)
+    _sqlite_connections[key] = conn
+  return conn
+
+def sqlite_close():
+  # Close the pooled connections of every thread of this process, the templates are rendered in
+  # other threads (PT.stream), so a connection may be closed by another thread than it was opened.
+  pid = os.getpid()
+  for key in [key for key in _sqlite_connections if key[0] == pid]:
+    _sqlite_connections.pop(key).close()
+
+# The parsed SQL files: real path -> ((mtime, size), queries)
+_sql_queries_cache = {}
+
+def sql_queries(sql_file):
+  # The named queries of the file: {name: query}, every query follows a '-- name: <name>' line
+  real_path = os.path.realpath(sql_file)
+  st = os.stat(real_path)
+  stamp = (st.st_mtime_ns, st.st_size)
+  cached = _sql_queries_cache.get(real_path)
+  if cached is None or cached[0] != stamp:
+    cached = _sql_queries_cache[real_path] = (stamp, _sql_parse_queries(file_read(real_path)))
+  return dict(cached[1])
+
+def _sql_parse_queries(text):
+  queries, name, lines = {}, None, []
+  for line in (text + '\n-- name: ').splitlines():
+    if line.strip().startswith('-- name:'):
+      if name is not None:
+        queries[name] = '\n'.join(lines).strip().rstrip(';').strip()
+      name, lines = line.split(':', 1)[1].strip(), []
+    else:
+      lines.append(line)
+  return queries
+
+class SqliteRows:
+  # The rows of a SQLite query for large results: every iteration runs the query again and fetches
+  # 'arraysize' rows at a time, so the rows are not kept in memory
+  def __init__(self, sql_file, sql_query, params=(), mode='rw', arraysize=256):
+    if not file_exists(sql_file):
+      raise FileNotFoundError('File not found: ' + sql_file)
+    self.sql_file = sql_file
+    self.sql_query = sql_query
+    self.params = params
+    self.mode = mode
+    self.arraysize = arraysize
+
+  def __iter__(self):
+    cursor = sqlite_connect(self.sql_file, self.mode).execute(self.sql_query, self.params)
+    try:
+      cursor.arraysize = self.arraysize
+      row_type = _sqlite_row_type(cursor) if cursor.description else SqliteRow
+      rows = cursor.fetchmany()
+      while rows:
+        yield from map(row_type, rows)
+        rows = cursor.fetchmany()
+    finally:
+      cursor.close()
+
+def data_sqlite(sql_file, sql_query, lazy=False, params=(), queries=None, mode='rw'):
+  # sql_query: the SQL or the name of a query in the 'queries' file (see sql_queries()),
+  # params: the bound parameters, a sequence for '?' or a dict for ':name'
+  if queries is not None:
+    sql_query = sql_queries(queries).get(sql_query, sql_query)
+  if lazy:
+    return SqliteRows(sql_file, sql_query, params, mode)
+  conn = sqlite_connect(sql_file, mode)
+  c = conn.execute(sql_query, params)
+  row_type = _sqlite_row_type(c) if c.description else SqliteRow
+  rows = [row_type(row) for row in c]
+  if conn.in_transaction:
+    conn.commit()
+  if len(rows) == 0:
+    return None
+  elif len(rows) == 1:
+    return rows[0]
+  else:
+    return rows
 
 def data_xml(xml_input):
+  from xml.etree.ElementTree import ParseError
   try:
-    if file_exists(xml_input):
-      domTree = xml.dom.minidom.parse(xml_input)
-    else:
-      domTree = xml.dom.minidom.parseString(xml_input)
-  except Exception as err:
+    for node in _xml_parse(xml_input, lambda names: len(names) == 1):
+      return node
+    raise ParseError('no element found')
+  except ParseError as err:
     if not file_exists(xml_input) and xml_input.endswith('.xml'):
       raise FileNotFoundError('File not found: ' + xml_input)
     raise SyntaxError('Failed to parse XML data: ' + str(err))
 
-  element = domTree.documentElement
-  return _xml2Dic(element)
+class XmlNode(OrderedDict):
+  # An element of the XML data. The items are the children by the tag name, node['<tag>'] (or node.<tag>)
+  # is the child of the tag, or the list of the children if the tag appears multiple times.
+  # text is None if the element has children.
+  __slots__ = ('tag', 'attrs', 'text', 'childs')
+
+  def __init__(self, tag, attrs, text, childs):
+    self.tag = tag
+    self.attrs = attrs
+    self.text = text
+    self.childs = childs
+    for child in childs:
+      same = self.get(child.tag)
+      if same is None:
+        self[child.tag] = child
+      elif type(same) is list:
+        same.append(child)
+      else:
+        self[child.tag] = [same, child]
+
+  def __getattr__(self, name):
+    try:
+      return self[name]
+    except KeyError:
+      raise AttributeError(name) from None
+
+  def __repr__(self):
+    return 'XmlNode(%r, %r, %r, %r)' % (self.tag, self.attrs, self.text, self.childs)
+
+def _xml_parse(xml_input, match):
+  # Parse the XML file or text by xml.etree iterparse, yield the nodes of the elements whose tag
+  # path (names) is matched. Every element is dropped when it is parsed, only the nodes of the
+  # matched elements are built.
+  import io
+  from xml.etree.ElementTree import iterparse
+  source = xml_input if file_exists(xml_input) else io.StringIO(xml_input)
+
+  prefixes = {}  # uri: prefix of the namespaces declared by the current element and its ancestors
+  def qname(name):
+    if name[:1] != '{':
+      return name
+    uri, name = name[1:].split('}', 1)
+    prefix = prefixes.get(uri)
+    return prefix + ':' + name if prefix else name
+
+  elements, names = [], []  # the path of the current element
+  childs = []               # the child nodes of the elements in the matched element
+  matched = 0               # the depth of the matched element, 0 if not in a matched element
+  declared = []             # the (prefix, uri) namespaces declared by the next element
+  scopes = {}               # element: (namespace declaration attributes, the replaced (uri, prefix) pairs)
+  for event, element in iterparse(source, ('start', 'end', 'start-ns')):
+    if event == 'start':
+      if declared:
+        replaced = [(uri, prefixes.get(uri)) for prefix, uri in declared]
+        prefixes.update((uri, prefix) for prefix, uri in declared)
+        scopes[element] = ({('xmlns:' + prefix if prefix else 'xmlns'): uri for prefix, uri in declared}, replaced)
+        declared = []
+      elements.append(element)
+      names.append(qname(element.tag))
+      if matched == 0 and match(names):
+        matched = len(names)
+      if matched:
+        childs.append([])
+    elif event == 'end':
+      scope = scopes.pop(element, None) if scopes else None
+      if matched:
+        nodes = childs.pop()
+        if scope is None:
+          attrs = {qname(key): val for key, val in element.attrib.items()}
+        else:
+          attrs = scope[0]
+          attrs.update((qname(key), val) for key, val in element.attrib.items())
+        node = XmlNode(names[-1], attrs, None if nodes else element.text or '', nodes)
+        if matched == len(names):
+          matched = 0
+          yield node
+        else:
+          childs[-1].append(node)
+      if scope is not None:
+        # The namespaces of the element go out of scope
+        for uri, prefix in reversed(scope[1]):
+          if prefix is None:
+            prefixes.pop(uri, None)
+          else:
+            prefixes[uri] = prefix
+      # Drop the parsed element. The parser reads ahead, the later siblings may be added to the parent
+      # already, the parsed element is the first child of the parent.
+      element.clear()
+      elements.pop()
+      if elements:
+        elements[-1].remove(element)
+      names.pop()
+    else:
+      declared.append(element)
+
+class XmlNodes:
+  # The elements of a large XML file which match the path, same to the nodes of data_xml(). Every
+  # iteration parses the file again and only the current element is kept in memory. The path is
+  # the tag names of the elements, 'item', 'items/item' or 'root/items/item' (the end of the
+  # element path), '*' for any tag.
+  def __init__(self, xml_input, path):
+    if not file_exists(xml_input) and xml_input.endswith('.xml') and '<' not in xml_input:
+      raise FileNotFoundError('File not found: ' + xml_input)
+    self.xml_input = xml_input
+    self.path = [name for name in path.split('/') if name]
+
+  def _match(self, names):
+    path = self.path
+    if len(names) < len(path):
+      return False
+    for name, tag in zip(path, names[len(names) - len(path):]):
+      if name != '*' and name != tag:
+        return False
+    return True
+
+  def __iter__(self):
+    from xml.etree.ElementTree import ParseError
+    try:
+      yield from _xml_parse(self.xml_input, self._match)
+    except ParseError as err:
+      raise SyntaxError('Failed to parse XML data: ' + str(err))
+
+def data_xml_nodes(xml_input, path):
+  # The matched elements of a large XML file, see XmlNodes
+  return XmlNodes(xml_input, path)
 
 def data_yaml(yaml_input):
   yaml = yaml_input
@@ -255,38 +542,6 @@ def _parseYamlObj(lines, spaces):
   else:
     raise ValueError('Faile to parse YAML file: invalid yaml line - ' + lines[0])
 
-def _xml2Dic(element):
-  ret = OrderedDict()
-  childs = []
-  attrs  = OrderedDict()
-  setattr(ret, 'tag',    element.tagName)
-  setattr(ret, 'attrs',  attrs)
-  setattr(ret, 'text',   None)
-  setattr(ret, 'childs', childs)
-
-  for key, val in element.attributes.items():
-    attrs[key] = val
-
-  txt = ''
-  for child in element.childNodes:
-    if isinstance(child, xml.dom.minidom.Element):
-      child = _xml2Dic(child)
-      childs.append(child)
-      child_name = child.tag
-      if hasattr(ret, child_name):
-        child_obj = getattr(ret, child_name)
-        if isinstance(child_obj, OrderedDict):
-          setattr(ret, child_name, [child_obj, child])
-          ret[child_name] = getattr(ret, child_name)
-        else:
-          child_obj.append(child)
-      else:
-        setattr(ret, child_name, child)
-        ret[child_name] = child
-    elif isinstance(child, xml.dom.minidom.Text):
-      txt += child.wholeText
-
-  if len(childs) == 0:
-    ret.text = txt
-  return ret
-
+# The public functions, PT.execute() imports them into the templates
+FUNCTIONS = {name: obj for name, obj in list(globals().items())
+             if type(obj) is types.FunctionType and not name.startswith('_')}
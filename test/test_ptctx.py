@@ -1,8 +1,13 @@
 #-*- coding: UTF-8 -*-
 import unittest
+import io
+import os
 import sys
+import contextlib
 sys.path.insert(0, "../")
 from ptctx import *
+from ptctx import _PTCtx, _compiled_templates
+import ptctx
 
 
 EXPRS_STR = '''
@@ -585,6 +590,20 @@ print('efg')
     t = {'val1': f}
     self.assertEqual('20', PT.eval(expr, {'t': t}))
 
+  def test_expr_prop_lookup(self):
+    # dic.key is the non-callable attribute, else the value of the key, else the attribute
+    class Obj(dict):
+      name = 'attr'
+    obj = Obj(name='key', items='key', other='key')
+    obj.other = None
+    self.assertEqual('attr,key,key', PT.eval('{{ o.name }},{{ o.items }},{{ o.other }}', {'o': obj}))
+    self.assertEqual('True,x', PT.eval("{{ callable(d.items) }},{{ n.a.b.text }}", {'d': {}, 'n': ptutil.data_xml('<r><a><b>x</b></a></r>')}))
+
+  def test_expr_filter_scope(self):
+    # The nested pipes have their own self, the pipe values do not leak into the variables
+    expr = '''{{ (a | self + (b | self * 2)) | self * 10 }},{{ [(x | self + 1) for x in (a | range(self))] }},{{ [k for k in globals() if k.startswith('__pt_')] }}'''
+    self.assertEqual('50,[1, 2, 3],[]', PT.eval(expr, {'a': 3, 'b': 1}))
+
   def test_tokens(self):
     s = '{{abc_def  7878.89\r\n  \t  \t_abc123 \n%} 9 a \t'
     t = Tokenizer(s)
@@ -821,3 +840,321 @@ def get_groups(val):
 {{- get_groups(5)}}'''
     ret = PT.eval(template)
     self.assertEqual(ret, "15")
+
+  def test_expr_compiled_once(self):
+    template = '''{% for i in range(3) %}{{ d.items[i].name | self.upper() }},{{ [x * 2 for x in d.nums] | len }};{% endfor %}'''
+    d = {'items': [{'name': 'a'}, {'name': 'b'}, {'name': 'c'}], 'nums': [1, 2]}
+    ctx = _PTCtx(template, {'d': d})
+    ret = ctx.eval()
+    self.assertEqual(ret, 'A,2;B,2;C,2;')
+    self.assertEqual(len(ctx._exprs), 2)
+
+  def test_code_cache(self):
+    cache_dir = './temp_cache'
+    ptutil.path_delete(cache_dir)
+    PT.set_cache_dir(cache_dir)
+    try:
+      hits, misses = PT.cache_stats()
+      template = '{% for i in range(3) %}{{ i | self * 2 }},{% endfor %}'
+      self.assertEqual(PT.eval(template), '0,2,4,')
+      self.assertEqual(PT.cache_stats(), (hits, misses + 1))
+      self.assertEqual(PT.eval(template), '0,2,4,')
+      self.assertEqual(PT.cache_stats(), (hits + 1, misses + 1))
+      self.assertEqual(len(ptutil.path_files(cache_dir, '*.ptc')), 1)
+    finally:
+      PT.set_cache_dir(None)
+      ptutil.path_delete(cache_dir)
+
+  def test_compiled_templates_registry(self):
+    PT.eval('./templates/students.pt', {'students': [{'name': 'joe', 'score': 88}] * 3})
+    student = os.path.realpath('./templates/student.pt')
+    self.assertIn(student, _compiled_templates)
+    code = _compiled_templates[student][1][1]
+    PT.eval('./templates/students.pt', {'students': [{'name': 'joe', 'score': 88}]})
+    self.assertIs(_compiled_templates[student][1][1], code)
+
+    # The template is translated again after it is modified
+    template = './temp_registry.pt'
+    ptutil.file_write_all(template, '{{ 1 + 1 }}')
+    self.assertEqual(PT.eval(template), '2')
+    ptutil.file_write_all(template, '{{ 1 + 1 }}-{{ 3 }}')
+    self.assertEqual(PT.eval(template), '2-3')
+    ptutil.file_delete(template)
+
+  def test_stream(self):
+    template = '''{% for i in range(1000) %}
+line {{ i }}
+{% endfor %}'''
+    chunks = list(PT.stream(template, chunk_size=100))
+    self.assertGreater(len(chunks), 10)
+    self.assertEqual(''.join(chunks), PT.eval(template))
+
+    # Stop reading in the middle of the output
+    gen = PT.stream(template, chunk_size=10)
+    self.assertTrue(next(gen).startswith('line 0'))
+    gen.close()
+
+    try:
+      list(PT.stream('{% raise ValueError("stream error") %}'))
+      self.assertFalse(True, "no exception")
+    except ValueError as e:
+      self.assertEqual(str(e), 'stream error')
+
+  def test_compile(self):
+    template = '{% for i in range(n) %}\n{{ name }} {{ i }}\n{% endfor %}'
+    compiled = PT.compile(template)
+    self.assertEqual(compiled.render({'name': 'a', 'n': 3}), PT.eval(template, {'name': 'a', 'n': 3}))
+    args_list = [{'name': 'n%d' % i, 'n': i} for i in range(5)]
+    self.assertEqual(compiled.render_batch(args_list), [PT.eval(template, args) for args in args_list])
+    # The variables of a render do not leak into the next one
+    self.assertEqual(PT.compile('{% x = globals().get("x", 0) + 1 %}{{ x }}').render_batch([{}, {}]), ['1', '1'])
+
+  def test_profile(self):
+    stacks_file = './temp_profile.txt'
+    args = {'students': [{'name': 'joe', 'score': 88}, {'name': 'martin', 'score': 90}]}
+    try:
+      ret = PT.eval('./templates/students.pt', args, profile=stacks_file)
+      self.assertEqual(ret, PT.eval('./templates/students.pt', args))
+      stacks = {}
+      for line in ptutil.file_read(stacks_file).splitlines():
+        stack, cost = line.rsplit(' ', 1)
+        stacks[stack] = int(cost)
+      self.assertIn(os.path.join('templates', 'students.pt') + ':4;@include student.pt', stacks)
+      self.assertIn(os.path.join('templates', 'students.pt') + ':9;' + os.path.join('templates', 'students.pt') + ' {{ idx }}', stacks)
+    finally:
+      ptutil.file_delete(stacks_file)
+
+  def test_source_map(self):
+    import traceback
+    template = 'line 1\n{% for i in range(2) %}\n  item {{ i }}\n  {% x = {}["k"] %}\n{% endfor %}\n'
+    try:
+      PT.eval(template)
+      self.assertFalse(True, "no exception")
+    except KeyError as e:
+      frame = traceback.extract_tb(e.__traceback__)[-1]
+      self.assertTrue(frame.filename.startswith('<template '))
+      self.assertEqual(frame.lineno, 4)
+      self.assertEqual(frame.line, '{% x = {}["k"] %}')
+
+    # Only the lines of the recent text templates are kept
+    import linecache
+    for i in range(ptctx._TEMPLATE_NAMES_MAX + 10):
+      PT.eval('{{ %d }}' % i)
+    names = [name for name in linecache.cache if name.startswith('<template ')]
+    self.assertEqual(len(names), ptctx._TEMPLATE_NAMES_MAX)
+    self.assertEqual(linecache.getline(names[-1], 1), '{{ %d }}' % (ptctx._TEMPLATE_NAMES_MAX + 9))
+
+    try:
+      PT.eval('a\n{% if x x %}\nb\n{% endif %}\n')
+      self.assertFalse(True, "no exception")
+    except SyntaxError as e:
+      self.assertEqual((e.lineno, e.offset), (2, 9))
+
+    ctx = _PTCtx('./templates/student.pt')
+    code = ctx.compile()[1]
+    self.assertEqual(code.co_filename, os.path.realpath('./templates/student.pt'))
+    self.assertEqual(ctx._lines[0], (1, 0))
+
+  def test_watch_dependencies(self):
+    job = ('./templates/students.pt', {'students': [{'name': 'joe', 'score': 88}]}, None)
+    (out, err), stamps = PT._render_tracked(job)
+    self.assertIsNone(err)
+    self.assertEqual(out, PT.eval(*job))
+    self.assertEqual(set(stamps), {os.path.realpath('./templates/students.pt'), os.path.realpath('./templates/student.pt')})
+    self.assertEqual(ptctx._changed(stamps), [])
+    self.assertIsNone(ptctx._dependencies)
+
+  def test_output_file_unchanged(self):
+    out_file = os.path.abspath('./temp_output.txt')
+    try:
+      written, unchanged = PT.output_stats()
+      PT.eval('Hello {{ name }}', {'name': 'a'}, out_file)
+      mtime = os.stat(out_file).st_mtime_ns
+      PT.eval('Hello {{ name }}', {'name': 'a'}, out_file)
+      self.assertEqual(os.stat(out_file).st_mtime_ns, mtime)
+      self.assertEqual(PT.output_stats(), (written + 1, unchanged + 1))
+
+      PT.eval('Hello {{ name }}', {'name': 'b'}, out_file)
+      self.assertEqual(ptutil.file_read(out_file), 'Hello b')
+      self.assertEqual(PT.output_stats(), (written + 2, unchanged + 1))
+
+      # A failed render keeps the old file
+      try:
+        PT.eval('Hello {{ name }}{% raise ValueError("failed") %}', {'name': 'c'}, out_file)
+        self.assertFalse(True, "no exception")
+      except ValueError:
+        pass
+      self.assertEqual(ptutil.file_read(out_file), 'Hello b')
+      self.assertEqual([f for f in os.listdir('.') if f.startswith('temp_output.txt.')], [])
+
+      # A failed option of the command line leaves no temporary file
+      template = './temp_output.pt'
+      ptutil.file_write_all(template, 'Hello')
+      try:
+        with contextlib.redirect_stdout(io.StringIO()):
+          PT.execute(['pt', template, '-out', out_file, '-json', 'x=./no_such_file.json'])
+          PT.execute(['pt', template, '-out', out_file, '-batch', './no_such_file.json'])
+      finally:
+        ptutil.file_delete(template)
+      self.assertEqual([f for f in os.listdir('.') if f.startswith('temp_output.txt.')], [])
+
+      # The output files of the same target do not share the temporary file
+      files = [ptctx._OutputFile(out_file), ptctx._OutputFile(out_file)]
+      files[0].write('first')
+      files[1].write('second')
+      self.assertTrue(files[0].close())
+      self.assertEqual(ptutil.file_read(out_file), 'first')
+      self.assertTrue(files[1].close())
+      self.assertEqual(ptutil.file_read(out_file), 'second')
+    finally:
+      ptutil.file_delete(out_file)
+
+  def test_execute_sql(self):
+    import sqlite3
+    db, template = './temp_execute.db', './temp_execute.pt'
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE t (id INTEGER, name TEXT)')
+    conn.executemany('INSERT INTO t VALUES (?, ?)', [(i, 'n%d' % i) for i in range(5)])
+    conn.commit()
+    conn.close()
+    ptutil.file_write_all(template, '{{ x.name }},{{ y.name }},{{ z.n }}')
+    try:
+      out = io.StringIO()
+      with contextlib.redirect_stdout(out):
+        # The variables are bound to the named parameters only
+        PT.execute(['pt', template, '-args', "{'id': 3}", '-sql', 'x=%s,SELECT name FROM t WHERE id = :id' % db,
+                    '-sql', 'y=%s,SELECT name FROM t WHERE id = 1' % db, '-sql', 'z=%s,SELECT 2 AS n' % db])
+      self.assertEqual(out.getvalue().split('\n')[0], 'n3,n1,2')
+    finally:
+      ptutil.file_delete(db)
+      ptutil.file_delete(template)
+
+  def test_template_globals(self):
+    # The templates see the ptutil functions and the names of the module, not its imports and helpers
+    self.assertEqual(PT.eval('{{ [name in globals() for name in ("file_exists", "os", "PT", "inspect", "gc", "re", "queue")] }}'),
+                     '[True, True, True, True, False, False, False]')
+    self.assertEqual(PT.eval('{{ inspect.isfunction(file_exists) }}'), 'True')
+
+  def test_pure_function(self):
+    template = """{%
+calls = []
+@pure(maxsize=10)
+def square(i):
+  calls.append(i)
+  return i * i
+%}
+{% for i in range(9) %}
+{{ (i % 3) | square }},{{ [i] | len }}
+{% endfor %}
+{{ len(calls) }}
+"""
+    ret = PT.eval(template)
+    self.assertEqual(ret.split(), ['0,1', '1,1', '4,1'] * 3 + ['3'])
+    # The caches live as long as the render
+    self.assertEqual(PT.eval(template).split()[-1], '3')
+    self.assertEqual(pure(abs)(-2), 2)
+    self.assertEqual(pure(abs).cache_info().misses, 0)
+    self.assertIsNone(getattr(ptctx._pure_scope, 'functions', None))
+
+  def test_pure_function_closure(self):
+    def make(n):
+      @pure
+      def add(x):
+        return x + n
+      return add
+    add1, add2 = make(1), make(2)
+    self.assertEqual((add1(10), add2(10), make(2)(10)), (11, 12, 12))
+    self.assertEqual(PT.eval('{{ 5 | add2 }}', {'add2': add2}), '7')
+
+    # In a render the function defined again shares the cache, but is called itself
+    template = """{%
+def make(n):
+  @pure
+  def add(x):
+    return x + n
+  return add
+%}{{ make(1)(10) }},{{ make(2)(10) }},{{ make(1)(10) }},{{ make(1).cache_info().hits }},{{ make(1).func is make(1).func }}"""
+    self.assertEqual(PT.eval(template), '11,12,11,1,False')
+
+  def test_render_many(self):
+    template = 'Hello {{ name }}{% assert name != "bad", "bad name" %}'
+    jobs = [(template, {'name': 'n%d' % i}, None) for i in range(20)]
+    jobs[5] = (template, {'name': 'bad'}, None)
+    jobs.append(('{% if %}', {}, None))
+    expected = [PT.eval(t, args) if i not in (5, 20) else None for i, (t, args, _) in enumerate(jobs)]
+
+    for processes in (1, 2):
+      results = PT.render_many(jobs, processes)
+      self.assertEqual([r[0] for r in results], expected)
+      self.assertEqual(results[5][1], "AssertionError: bad name")
+      self.assertTrue(results[20][1].startswith('SyntaxError'))
+      self.assertEqual(sum(1 for r in results if r[1] is None), 19)
+
+    # A job that cannot be sent to the worker processes fails alone
+    jobs[3] = (template, {'name': 'n3', 'f': lambda: 0}, None)
+    results = PT.render_many(jobs, 2)
+    self.assertEqual(results[3][0], None)
+    self.assertIn('pickle', results[3][1])
+    self.assertEqual([r[0] for i, r in enumerate(results) if i != 3], expected[:3] + expected[4:])
+
+    # The spawned workers start without the state of this process
+    jobs = [("{{ file_exists('test_ptctx.py') }} {{ name }}", {'name': 'n%d' % i}, None) for i in range(2)]
+    self.assertEqual(PT.render_many(jobs, 2, 'spawn'), [('True n0', None), ('True n1', None)])
+
+    # The output files written by the worker processes are counted in this process
+    out_files = [os.path.abspath('./temp_render_many_%d.txt' % i) for i in range(2)]
+    try:
+      jobs = [('Hello {{ name }}', {'name': 'n%d' % i}, out_files[i]) for i in range(2)]
+      written, unchanged = PT.output_stats()
+      PT.render_many(jobs, 2)
+      PT.render_many(jobs[:1], 2)
+      PT.render_many(jobs + jobs[:1], 2)
+      self.assertEqual(PT.output_stats(), (written + 2, unchanged + 4))
+    finally:
+      for out_file in out_files:
+        ptutil.file_delete(out_file)
+
+  def test_tokenizer_same_to_char_tokenizer(self):
+    def tokens(cls, text, options):
+      t = cls(text)
+      ret = []
+      while True:
+        tok = t.next_tok(*options)
+        if tok is None:
+          return ret
+        ret.append((tok.text, tok.line, tok.offset))
+
+    def lines(cls, text):
+      t = cls(text)
+      ret = []
+      while True:
+        try:
+          line = t.next_line()
+        except SyntaxError as ex:
+          return ret + [str(ex)]
+        if line is None:
+          return ret
+        ret.append((line.type, [(tok.text, tok.line, tok.offset) for tok in line._tokens], line.is_single_line_code,
+                    line.code_offset, line.remove_head_blank, line.remove_tail_blank))
+
+    texts = [EXPRS_STR, '{{abc_def  7878.89\r\n  \t  \t_abc123 \n%} 9 a \t', "a\r#b\r\nc//d\r/*e\rf*/'g\\'h'\"\"\"i\nj\"\"\" k"]
+    for f in ptutil.path_files('./templates', '*.pt'):
+      texts.append(ptutil.file_read(f))
+    options = [(True, False, True, []), (False, False, False, ['{{', '{%']), (True, True, True, ['%}']), (True, False, True, ['}}'])]
+    for text in texts:
+      for option in options:
+        self.assertEqual(tokens(Tokenizer, text, option), tokens(CharTokenizer, text, option))
+      self.assertEqual(lines(Tokenizer, text), lines(CharTokenizer, text))
+
+    # The template is translated by the tokenizer class of _PTCtx
+    used = []
+    class UsedCharTokenizer(CharTokenizer):
+      def __init__(self, text):
+        used.append(text)
+        CharTokenizer.__init__(self, text)
+    _PTCtx._tokenizer_class = UsedCharTokenizer
+    try:
+      self.assertEqual(PT.eval('{% for i in range(3) %}{{ i }}{% endfor %} char tokenizer'), '012 char tokenizer')
+      self.assertEqual(used, ['{% for i in range(3) %}{{ i }}{% endfor %} char tokenizer'])
+    finally:
+      _PTCtx._tokenizer_class = Tokenizer
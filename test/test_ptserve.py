@@ -0,0 +1,67 @@
+#-*- coding: UTF-8 -*-
+import unittest
+import os
+import sys
+import time
+import socket
+import tempfile
+import threading
+sys.path.insert(0, "../")
+import ptserve
+from ptutil import *
+
+class test_ptserve(unittest.TestCase):
+  def test_serve(self):
+    socket_path = os.path.join(tempfile.gettempdir(), 'pt-test-%d.sock' % os.getpid())
+    template = './temp_serve.pt'
+    ready = threading.Event()
+    server = threading.Thread(target=ptserve.serve, args=(socket_path, ready.set), daemon=True)
+    server.start()
+    try:
+      self.assertTrue(ready.wait(5))
+      file_write_all(template, 'Hello {{ name }}')
+      self.assertEqual(ptserve.execute(socket_path, [template, '-args', "{'name': 'pt'}"]), 'Hello pt\n')
+
+      # The modified template is compiled again
+      time.sleep(0.01)
+      file_write_all(template, 'Bye {{ name }}!')
+      self.assertEqual(ptserve.execute(socket_path, [template, '-args', "{'name': 'pt'}"]), 'Bye pt!\n')
+
+      self.assertTrue(ptserve.execute(socket_path, ['./no_such_file.pt']).startswith('ERROR: Can not find template file'))
+
+      # A template calling exit() or a -watch request does not stop the server
+      file_write_all(template, '{% import sys; sys.exit(3) %}')
+      self.assertRaisesRegex(RuntimeError, 'SystemExit: 3', ptserve.execute, socket_path, [template])
+      self.assertRaisesRegex(RuntimeError, '-watch', ptserve.execute, socket_path, [template, '-watch', '1'])
+      file_write_all(template, 'Bye {{ name }}!')
+
+      # The socket of the running server is not replaced
+      self.assertRaises(FileExistsError, ptserve.serve, socket_path)
+      self.assertEqual(ptserve.execute(socket_path, [template, '-args', "{'name': 'pt'}"]), 'Bye pt!\n')
+    finally:
+      ptserve.stop(socket_path)
+      server.join(5)
+      file_delete(template)
+    self.assertFalse(server.is_alive())
+    self.assertFalse(os.path.exists(socket_path))
+
+  def test_serve_stale_socket(self):
+    socket_path = os.path.join(tempfile.gettempdir(), 'pt-test-stale-%d.sock' % os.getpid())
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()  # the socket file is left without a server
+    ready = threading.Event()
+    server = threading.Thread(target=ptserve.serve, args=(socket_path, ready.set), daemon=True)
+    server.start()
+    try:
+      self.assertTrue(ready.wait(5))
+      self.assertEqual(ptserve.execute(socket_path, ['./no_such_file.pt'])[:6], 'ERROR:')
+    finally:
+      ptserve.stop(socket_path)
+      server.join(5)
+    self.assertFalse(os.path.exists(socket_path))
+
+
+if __name__ == '__main__':
+  pass
+  #unittest.main()
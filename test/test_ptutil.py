@@ -3,6 +3,7 @@ import unittest
 import sys
 sys.path.insert(0, "../")
 from ptutil import *
+import ptutil
 
 class test_ptutil(unittest.TestCase):
   def test_file_ops1(self):
@@ -97,6 +98,46 @@ class test_ptutil(unittest.TestCase):
     self.assertEqual(m.child.attrs['a'], 'a')
     self.assertEqual(m.child.text, 'child text')
     self.assertEqual(m.childs[2].text, 'child text')
+    self.assertIs(m['child'], m.child)
+    self.assertEqual(list(m.keys()), ['node', 'child'])
+    self.assertIsNone(m.text)
+
+    # The children whose tags are the names of the node properties
+    m = data_xml('<joe><items>a</items><tag>b<![CDATA[c]]>d</tag></joe>')
+    self.assertEqual((m.tag, m['items'].text, m['tag'].text), ('joe', 'a', 'bcd'))
+    self.assertRaises(AttributeError, getattr, m, 'none')
+    self.assertRaises(SyntaxError, data_xml, '<joe>')
+
+  def test_data_xml_nodes(self):
+    input = '''<joe xmlns:p="urn:p" attr1="abc">
+        <node n="aaa"><p:name p:lang="en">first</p:name></node>
+        <group><node n="bbb">second</node></group>
+        <node n="ccc">third<!-- comment --> node</node>
+      </joe>'''
+    nodes = data_xml_nodes(input, 'node')
+    self.assertEqual([n.attrs['n'] for n in nodes], ['aaa', 'bbb', 'ccc'])
+    first, second, third = list(nodes)
+    full = data_xml(input)
+    self.assertEqual(first['p:name'].text, full.node[0]['p:name'].text)
+    self.assertEqual(first.childs[0].attrs, OrderedDict([('p:lang', 'en')]))
+    self.assertEqual(full.attrs, {'xmlns:p': 'urn:p', 'attr1': 'abc'})
+    m = data_xml('<joe xmlns="urn:d"><node xmlns:q="urn:q" q:a="1"/></joe>')
+    self.assertIsInstance(m, OrderedDict)
+    self.assertEqual((m.tag, m.attrs, m.node.attrs), ('joe', {'xmlns': 'urn:d'}, {'xmlns:q': 'urn:q', 'q:a': '1'}))
+    # The prefixes are resolved in the scope of the declaring element
+    m = data_xml('<r xmlns:a="urn:1"><a:x/><s xmlns:b="urn:1" xmlns:a="urn:2"><a:y/><b:z/></s><a:w/></r>')
+    self.assertEqual([c.tag for c in m.childs], ['a:x', 's', 'a:w'])
+    self.assertEqual([c.tag for c in m.s.childs], ['a:y', 'b:z'])
+    # Many siblings (the parser reads ahead of the finished elements)
+    items = ''.join('<item n="%d">%s</item>' % (i, 'x' * (i % 50)) for i in range(5000))
+    self.assertEqual([(n.attrs['n'], len(n.text)) for n in data_xml_nodes('<r>' + items + '</r>', 'item')],
+                     [(str(i), i % 50) for i in range(5000)])
+    self.assertEqual((first.text, second.text, third.text), (None, 'second', 'third node'))
+    self.assertEqual(len(first.childs), 1)
+    self.assertEqual([n.attrs['n'] for n in data_xml_nodes(input, 'joe/node')], ['aaa', 'ccc'])
+    self.assertEqual([n.tag for n in data_xml_nodes(input, 'joe/*')], ['node', 'group', 'node'])
+    self.assertRaises(FileNotFoundError, data_xml_nodes, './invalid/invalid.xml', 'node')
+    self.assertRaises(SyntaxError, list, data_xml_nodes('<joe><node></joe>', 'node'))
 
   def test_data_json_not_found(self):
     try:
@@ -188,6 +229,80 @@ g = fsafdsa
     self.assertEqual(x['b'], 'ab')
     self.assertEqual(x['c'], "['a','b']")
 
+  def test_data_sqlite_lazy(self):
+    import sqlite3
+    db = './temp_rows.db'
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE t (id INTEGER, name TEXT)')
+    conn.executemany('INSERT INTO t VALUES (?, ?)', [(i, 'n%d' % i) for i in range(1000)])
+    conn.commit()
+    conn.close()
+    try:
+      rows = data_sqlite(db, 'SELECT id, name FROM t WHERE id < 600', lazy=True)
+      self.assertEqual([r['name'] for r in rows], ['n%d' % i for i in range(600)])
+      # Every iteration runs the query again
+      self.assertEqual(sum(r[0] for r in rows), sum(range(600)))
+      self.assertEqual(data_sqlite(db, 'SELECT id, name FROM t WHERE id = 7')['name'], 'n7')
+      self.assertRaises(FileNotFoundError, data_sqlite, './temp_no_such.db', 'SELECT 1', True)
+
+      row = data_sqlite(db, 'SELECT id, name, id * 2 AS "count" FROM t WHERE id = 3')
+      self.assertEqual((row.id, row.name, row['name'], row[0]), (3, 'n3', 'n3', 3))
+      self.assertEqual(row.items(), [('id', 3), ('name', 'n3'), ('count', 6)])
+      self.assertEqual(list(row), ['id', 'name', 'count'])
+      self.assertEqual(dict(row), {'id': 3, 'name': 'n3', 'count': 6})
+      self.assertEqual((row['count'], row.get('none', 0), 'name' in row, 'n3' in row), (6, 0, True, False))
+      # The rows of the same columns share the row type
+      rows = data_sqlite(db, 'SELECT id, name FROM t WHERE id < 3')
+      self.assertIs(type(rows[0]), type(next(iter(data_sqlite(db, 'SELECT id, name FROM t', lazy=True)))))
+      import pickle
+      copy = pickle.loads(pickle.dumps(row))
+      self.assertEqual((copy.items(), copy.name), (row.items(), 'n3'))
+      self.assertIs(type(copy), type(row))
+    finally:
+      sqlite_close()
+      file_delete(db)
+
+  def test_data_sqlite_queries(self):
+    import sqlite3
+    db, sql = './temp_queries.db', './temp_queries.sql'
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE t (id INTEGER, name TEXT)')
+    conn.executemany('INSERT INTO t VALUES (?, ?)', [(i, 'n%d' % i) for i in range(10)])
+    conn.commit()
+    conn.close()
+    file_write_all(sql, '-- name: by_id\nSELECT name FROM t\nWHERE id = :id;\n\n-- name: below\nSELECT id FROM t WHERE id < ?\n')
+    try:
+      self.assertEqual(sql_queries(sql), {'by_id': 'SELECT name FROM t\nWHERE id = :id', 'below': 'SELECT id FROM t WHERE id < ?'})
+      self.assertEqual(data_sqlite(db, 'by_id', params={'id': 4}, queries=sql).name, 'n4')
+      self.assertEqual([r.id for r in data_sqlite(db, 'below', True, (3,), sql, 'ro')], [0, 1, 2])
+      self.assertEqual(len(data_sqlite(db, 'SELECT * FROM t WHERE id > ?', params=(5,), mode='immutable')), 4)
+      # The queries are parsed again when the file changes
+      self.assertIs(sql_queries(sql)['below'], sql_queries(sql)['below'])
+      file_write_all(sql, '-- name: below\nSELECT id FROM t WHERE id <= ?\n')
+      self.assertEqual(sql_queries(sql), {'below': 'SELECT id FROM t WHERE id <= ?'})
+
+      # The connection of a file and mode is opened once
+      self.assertIs(sqlite_connect(db, 'ro'), sqlite_connect(db, 'ro'))
+      self.assertIsNot(sqlite_connect(db, 'ro'), sqlite_connect(db))
+      self.assertRaises(sqlite3.OperationalError, data_sqlite, db, 'DELETE FROM t', mode='ro')
+      data_sqlite(db, 'DELETE FROM t WHERE id = 9')
+      sqlite_close()
+      self.assertEqual(data_sqlite(db, 'SELECT COUNT(*) AS n FROM t', mode='ro').n, 9)
+      # The connections opened by other threads are closed too
+      import threading
+      thread = threading.Thread(target=data_sqlite, args=(db, 'SELECT 1 AS n'))
+      thread.start()
+      thread.join()
+      conns = list(ptutil._sqlite_connections.values())
+      self.assertEqual(len(conns), 2)
+      sqlite_close()
+      self.assertEqual(ptutil._sqlite_connections, {})
+      self.assertRaises(sqlite3.ProgrammingError, conns[1].execute, 'SELECT 1')
+    finally:
+      sqlite_close()
+      file_delete(db)
+      file_delete(sql)
+
   def test_data_yaml_not_found(self):
     try:
       m = data_yaml("./invalid/invalid.yaml")
@@ -242,6 +357,23 @@ components:
     self.assertEqual(m['paths']['/path/path1/path2']['post']['responses']['\'200\'']['content']['application/json']['schema']['$ref'], "'#/components/schemas/Data_Struct'")
     self.assertEqual(m['components']['schemas']['Data_Struct']['properties']['serverStatus']['enum'][0], '0 - ONE')
 
+  def test_file_equal(self):
+    file_write_all('./temp_equal1.txt', 'hello')
+    file_write_all('./temp_equal2.txt', 'hello')
+    self.assertTrue(file_equal('./temp_equal1.txt', './temp_equal2.txt'))
+    file_write_all('./temp_equal2.txt', 'hellO')
+    self.assertFalse(file_equal('./temp_equal1.txt', './temp_equal2.txt'))
+    self.assertFalse(file_equal('./temp_equal1.txt', './temp_equal3.txt'))
+    file_delete('./temp_equal1.txt')
+    file_delete('./temp_equal2.txt')
+
+  def test_functions(self):
+    import ptutil
+    self.assertIs(ptutil.FUNCTIONS['data_json'], data_json)
+    self.assertIs(ptutil.FUNCTIONS['file_read'], file_read)
+    self.assertNotIn('OrderedDict', ptutil.FUNCTIONS)
+    self.assertNotIn('_xml2Dic', ptutil.FUNCTIONS)
+
 
 if __name__ == '__main__':
   pass